@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# NOTE: Allow running the suite from a checkout without installing Carton
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from carton.core import Core
+from carton.modules import config
+
+PLUGIN = '''from carton import hook, Module, proc
+
+class Bench{index}Module(Module):
+    @hook('environment.bench{index}')
+    def variable(self):
+        return {index}
+
+    @proc('bench{index}')
+    def bench(self):
+        return {index}
+'''
+
+def _condition(level, index, plugins):
+    kinds = (
+        "host == 'bench-{index}'",
+        "platform == 'Linux' and user != 'bench-{index}'",
+        "which('bench-{index}') is None",
+    )
+    if plugins > 0:
+        kinds += ("bench{plugin} == {plugin}",)
+
+    kind = kinds[(level + index) % len(kinds)]
+    return kind.format(index=index, plugin=index % max(plugins, 1))
+
+def _patches(options, level, first):
+    patches = []
+    if level >= options.depth:
+        return patches
+
+    per_level = max(options.conditions // options.depth, 1)
+    for index in range(first, first + per_level):
+        condition = _condition(level, index, options.plugins)
+        patch = {'if': condition, 'bench': {str(index): [index]}}
+        patch['patch'] = _patches(options, level + 1, index * per_level)
+        patches.append(patch)
+    return patches
+
+def generate(directory, options):
+    root = os.path.join(directory, 'root')
+    home = os.path.join(directory, 'home')
+    refs = os.path.join(root, 'repository', 'refs')
+    os.makedirs(refs)
+
+    install = {}
+    for index in range(options.links):
+        reference = 'group{group}/file{index}'.format(group=index % 50, index=index)
+        os.makedirs(os.path.join(refs, os.path.dirname(reference)), exist_ok=True)
+        with open(os.path.join(refs, reference), 'w') as f:
+            f.write(str(index))
+        target = os.path.join(home, 'dir{group}'.format(group=index % 100), 'file{index}'.format(index=index))
+        install[target] = reference
+
+    database = {'install': install, 'patch': _patches(options, 0, 0)}
+    with open(os.path.join(root, 'repository', 'carton.json'), 'w') as f:
+        json.dump(database, f)
+
+    plugins = os.path.join(directory, 'plugins')
+    os.makedirs(plugins)
+    for index in range(options.plugins):
+        with open(os.path.join(plugins, 'carton_bench{index}.py'.format(index=index)), 'w') as f:
+            f.write(PLUGIN.format(index=index))
+
+    return root, plugins
+
+def measure(results, name, f):
+    start = time.perf_counter()
+    value = f()
+    results.setdefault(name, []).append(time.perf_counter() - start)
+    return value
+
+def run(options, results):
+    with tempfile.TemporaryDirectory() as directory:
+        root, plugins = generate(directory, options)
+        sys.path.insert(0, plugins)
+        config._conditions.clear()
+
+        try:
+            core = measure(results, 'core.init.cold', lambda: Core(root))
+            module = core._modules['config.ConfigModule']
+
+            measure(results, 'config.reduce', lambda: module._reduce(module.database, module.environment))
+            measure(results, 'config.get.copy', lambda: core.proc('get', 'install'))
+            measure(results, 'config.get.view', lambda: core.proc('get', 'install', view=True))
+
+            def sets():
+                with core.proc('transaction'):
+                    for index in range(options.sets):
+                        core.proc('set', 'bench', str(index), value=index)
+            measure(results, 'config.set.transaction', sets)
+            measure(results, 'config.set.single', lambda: core.proc('set', 'bench', 'single', value=0))
+
+            measure(results, 'packer.unpack.cold', lambda: core.proc('unpack'))
+            measure(results, 'packer.unpack.warm', lambda: core.proc('unpack'))
+            measure(results, 'packer.unpack.incremental', lambda: core.proc('unpack', incremental=True))
+            measure(results, 'core.shutdown.dirty', core.shutdown)
+
+            core = measure(results, 'core.init.warm', lambda: Core(root))
+            name = 'config.ConfigModule'
+            core.disable(name)
+            measure(results, 'config.on_load.cached', lambda: core.enable(name))
+            core.disable(name)
+            os.unlink(os.path.join(root, 'state', 'reduced.json'))
+            measure(results, 'config.on_load.uncached', lambda: core.enable(name))
+            measure(results, 'packer.unpack.incremental.warm', lambda: core.proc('unpack', incremental=True))
+            measure(results, 'core.shutdown.clean', core.shutdown)
+        finally:
+            sys.path.remove(plugins)
+            for module in list(sys.modules):
+                if module.startswith('carton_bench'):
+                    del sys.modules[module]
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ('git', 'rev-parse', 'HEAD'),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Carton on synthetic repositories.')
+    parser.add_argument('--links', type=int, default=1000, help='number of installed files')
+    parser.add_argument('--depth', type=int, default=3, help='nesting depth of patches')
+    parser.add_argument('--conditions', type=int, default=60, help='number of patches per level, spread over depth')
+    parser.add_argument('--plugins', type=int, default=10, help='number of system modules')
+    parser.add_argument('--sets', type=int, default=100, help='number of keys set in a transaction')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs')
+    parser.add_argument('-o', '--output', default=None, help='write results to this file')
+    options = parser.parse_args(argv)
+
+    results = {}
+    for _ in range(options.repeat):
+        run(options, results)
+
+    report = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(options),
+        'results': {
+            name: {
+                'runs': len(timings),
+                'min': min(timings),
+                'median': statistics.median(timings),
+                'mean': statistics.mean(timings),
+                'max': max(timings),
+            }
+            for name, timings in results.items()
+        }
+    }
+
+    data = json.dumps(report, indent=2)
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
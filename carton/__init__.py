@@ -1 +1,2 @@
 from carton.core import hook, Module, proc
+from carton.cli import main
@@ -0,0 +1,79 @@
+import argparse
+import json
+import sys
+
+from carton import daemon
+from carton.core import Core
+from carton.util import strings as s
+
+# NOTE: These procs never modify state, so they run in shared, read-only
+# sessions when no daemon is available
+READ_ONLY = ('get', 'links', 'plan', 'status', 'trace')
+
+def _value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def _parse(arguments):
+    args, kwargs = [], {}
+    for argument in arguments:
+        if argument.startswith('--'):
+            key, separator, value = argument[2:].partition('=')
+            kwargs[key.replace('-', '_')] = _value(value) if separator else True
+        else:
+            args.append(argument)
+
+    return args, kwargs
+
+def run(name, *args, root=None, daemonized=True, timeout=None, **kwargs):
+    if daemonized and name not in daemon.BLOCKING:
+        try:
+            return daemon.request('proc', name, *args, root=root, **kwargs)
+        except daemon.DaemonUnavailable:
+            pass
+
+    core = Core(root, readonly=name in READ_ONLY, timeout=timeout)
+    try:
+        return core.proc(name, *args, **kwargs)
+    finally:
+        core.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='carton',
+        description='An extensive and extensible dotfiles manager.')
+    parser.add_argument('-r', '--root', default=None,
+        help='directory holding the repository and state')
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+        help='seconds to wait for another session to finish')
+    parser.add_argument('--no-daemon', action='store_true',
+        help='always run in this process')
+    parser.add_argument('command',
+        help="a proc to run, or 'daemon' and 'stop' to manage the daemon")
+    parser.add_argument('arguments', nargs=argparse.REMAINDER,
+        help='positional arguments, and --key=value keyword arguments')
+    options = parser.parse_args(argv)
+
+    args, kwargs = _parse(options.arguments)
+    try:
+        if options.command == 'daemon':
+            daemon.serve(options.root, timeout=options.timeout)
+            result = None
+        elif options.command == 'stop':
+            result = daemon.request('stop', root=options.root)
+        else:
+            result = run(
+                options.command, *args,
+                root=options.root,
+                daemonized=not options.no_daemon,
+                timeout=options.timeout,
+                **kwargs)
+    except Exception as e:
+        print(s.COMMAND_FAILED.format(error=e), file=sys.stderr)
+        return 1
+
+    if result is not None:
+        print(json.dumps(result, indent=2, default=daemon.encode))
+    return 0
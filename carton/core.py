@@ -1,9 +1,19 @@
+import asyncio
 import collections
+import contextlib
 import functools
+import inspect
+import json
+import marshal
+import os
 import pkgutil
 import importlib
+import importlib.util
+import sys
+import time
 import types
-from carton.util import path, strings as s
+from concurrent import futures
+from carton.util import lock, path, strings as s, trace as trace_
 
 class Module:
     def __init__(self, core):
@@ -12,13 +22,13 @@ class Module:
     def get_hook(self, _name):
         for name in dir(self):
             value = getattr(self, name)
-            if _name in getattr(value, '_hooks', ()):
+            if callable(value) and _name in getattr(value, '_hooks', ()):
                 return value
 
     def get_proc(self, _name):
         for name in dir(self):
             value = getattr(self, name)
-            if _name in getattr(value, '_procs', ()):
+            if callable(value) and _name in getattr(value, '_procs', ()):
                 return value
 
     def acquire(self, resource):
@@ -64,32 +74,280 @@ def proc(value, name=None):
 
     return value
 
+# NOTE: These hooks are fired by Core itself and never cause a dormant system
+# module to be imported
+LIFECYCLE = ('load', 'unload', 'enable', 'disable')
+
+def _inspect(module):
+    if callable(getattr(module, 'setup', None)):
+        return None
+
+    names = {'hooks': set(), 'procs': set()}
+    for identifier in dir(module):
+        value = getattr(module, identifier, None)
+        if isinstance(value, Module):
+            value = type(value)
+        if not isinstance(value, type) or not issubclass(value, Module):
+            continue
+
+        for attribute in dir(value):
+            f = getattr(value, attribute, None)
+            if callable(f):
+                names['hooks'].update(getattr(f, '_hooks', ()))
+                names['procs'].update(getattr(f, '_procs', ()))
+
+    names['hooks'].difference_update(LIFECYCLE)
+    if len(names['hooks']) == 0 and len(names['procs']) == 0:
+        return None
+
+    return {key: sorted(value) for key, value in names.items()}
+
+async def _gather(results):
+    pending = [name for name, value in results.items() if inspect.isawaitable(value)]
+    values = await asyncio.gather(*(results[name] for name in pending))
+
+    results = collections.OrderedDict(results)
+    for name, value in zip(pending, values):
+        results[name] = value
+    return results
+
+# NOTE: Awaitables met by synchronous calls are run to completion, on a thread
+# of their own if this thread already runs an event loop
+def _run(awaitable):
+    async def wrapper():
+        return await awaitable
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(wrapper())
+
+    with futures.ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, wrapper()).result()
+
+def _stamp(entry):
+    try:
+        return os.stat(entry).st_mtime_ns
+    except OSError:
+        return None
+
+# System module discovery, cached in the given file and invalidated whenever an
+# entry of sys.path or a discovered module changes
+def discover(cache=None):
+    entries = [os.path.abspath(entry or os.curdir) for entry in sys.path]
+    stamps = [[entry, _stamp(entry)] for entry in entries]
+
+    try:
+        if cache is not None:
+            with open(str(cache)) as f:
+                data = json.load(f)
+
+            fresh = data['path'] == stamps
+            for origin, stamp in data['origins'].values():
+                fresh = fresh and _stamp(origin) == stamp
+            if fresh:
+                return collections.OrderedDict(data['plugins'])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        # NOTE: json.decoder.JSONDecodeError is a subclass of ValueError
+        pass
+
+    plugins = collections.OrderedDict()
+    origins = {}
+    for module in map(lambda m: m.name, pkgutil.iter_modules()):
+        if module.startswith('carton_'):
+            imported = importlib.import_module(module)
+            plugins[module] = _inspect(imported)
+
+            origin = getattr(imported, '__file__', None)
+            if origin is not None:
+                origins[module] = [origin, _stamp(origin)]
+
+    if cache is not None:
+        data = {'path': stamps, 'origins': origins, 'plugins': plugins}
+        try:
+            path.write(cache, json.dumps(data))
+        except OSError:
+            pass
+
+    return plugins
+
+def _execute(name, file, compiled, code):
+    module = types.ModuleType(name)
+    module.__file__ = str(file)
+    module.__cached__ = str(compiled)
+    sys.modules[name] = module
+    try:
+        exec(code, module.__dict__)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+# NOTE: Modules already executed from the same bytecode are reused
+def _import(name, file, compiled):
+    loaded = sys.modules.get(name, None)
+    if getattr(loaded, '__cached__', None) == str(compiled):
+        return loaded
+
+    magic = importlib.util.MAGIC_NUMBER
+    try:
+        with open(str(compiled), 'rb') as f:
+            data = f.read()
+        if data[:len(magic)] != magic:
+            raise ValueError(compiled)
+        code = marshal.loads(data[len(magic):])
+    except (OSError, ValueError, EOFError, TypeError):
+        code = compile(file.read_bytes(), str(file), 'exec')
+
+    return _execute(name, file, compiled, code)
+
+# Repository module discovery. Sources are compiled once, and their bytecode is
+# cached in the state directory along with the names they provide, keyed by the
+# hash of their source. This maps module names to these names and a function
+# returning the module itself
+def local(directory, state):
+    cache = state / 'modules.json'
+    bytecode = state / 'bytecode'
+    magic = importlib.util.MAGIC_NUMBER.hex()
+
+    try:
+        with open(str(cache)) as f:
+            data = json.load(f)
+        index = data['modules'] if data['magic'] == magic else {}
+    except (OSError, ValueError, KeyError, TypeError):
+        index = {}
+
+    try:
+        files = sorted(directory.glob('*.py'))
+    except OSError:
+        files = []
+
+    modules = collections.OrderedDict()
+    fresh = {}
+    for file in files:
+        name = 'carton_' + file.stem
+        source = file.read_bytes()
+        digest = importlib.util.source_hash(source).hex()
+        compiled = bytecode / '{stem}-{digest}.pyc'.format(stem=file.stem, digest=digest)
+
+        entry = index.get(name, None)
+        if isinstance(entry, dict) and entry.get('hash', None) == digest and \
+                compiled.exists():
+            names = entry.get('names', None)
+        else:
+            code = compile(source, str(file), 'exec')
+            try:
+                bytecode.mkdir(exist_ok=True)
+                for stale in bytecode.glob(file.stem + '-*.pyc'):
+                    stale.unlink()
+                path.write(compiled, importlib.util.MAGIC_NUMBER + marshal.dumps(code))
+            except OSError:
+                pass
+
+            names = _inspect(_execute(name, file, compiled, code))
+
+        modules[name] = (names, functools.partial(_import, name, file, compiled))
+        fresh[name] = {'hash': digest, 'names': names}
+
+    if fresh != index:
+        try:
+            path.write(cache, json.dumps({'magic': magic, 'modules': fresh}))
+        except OSError:
+            pass
+
+    return modules
+
 class Core:
-    def __init__(self, root=None):
+    # NOTE: Read-only sessions share their lock with each other, the timeout is
+    # how long to wait for it, None meaning forever
+    # NOTE: Tracing records every hook, proc and module load, and is enabled
+    # with trace, or by pointing CARTON_TRACE to a file that gets a Chrome trace
+    # of the session on shutdown
+    def __init__(self, root=None, plugins=None, *, readonly=False, timeout=0, trace=False):
         self.repository = path.repository(root)
         self.state = path.state(root)
+        self.readonly = readonly
 
-        lock = self.state / 'carton.lock'
-        if lock.exists():
-            raise FileExistsError(s.FILE_EXISTS.format(path=lock))
+        self._trace = os.getenv('CARTON_TRACE', None)
+        if trace or self._trace:
+            self._tracer = trace_.Tracer()
+        else:
+            self._tracer = None
 
-        lock.touch()
+        self._lock = lock.Lock(
+            self.state / 'carton.lock', shared=readonly, timeout=timeout)
+        self._lock.acquire()
         self._acquired = True
 
         self._locks = {}
         self._modules = collections.OrderedDict()
 
+        # NOTE: These map hook and proc names to an ordered mapping of enabled
+        # module names to handlers, and mirror the order of self._modules
+        self._hooks = {}
+        self._procs = {}
+
+        # NOTE: Dormant system modules are indexed by the names they provide
+        self._pending = collections.OrderedDict()
+        self._dormant = {'hooks': {}, 'procs': {}}
+
+        # Index system and repository modules first, so that core modules may
+        # wake them up while loading, but defer their import until first use
+        if plugins is None:
+            plugins = discover(self.state / 'plugins.json')
+        for module, names in plugins.items():
+            if names is not None:
+                self._index(module, names)
+
+        # NOTE: Repository modules are carton_* modules too, and may not share
+        # their name with a system module
+        self._local = local(self.repository / 'modules', self.state)
+        for module, (names, loader) in self._local.items():
+            if module in plugins:
+                raise ValueError(s.MODULE_LOADED.format(module=module[7:]))
+            elif names is not None:
+                self._index(module, names)
+
         # Load core modules
         modules = path.clean(__file__).parent / 'modules'
-        for module in map(lambda m: m.name, pkgutil.iter_modules((modules,))):
+        core = [m.name for m in pkgutil.iter_modules((modules,))]
+        for module in core:
             self.load_from('carton.modules.{name}'.format(name=module))
 
-        # Load system modules
-        for module in map(lambda m: m.name, pkgutil.iter_modules()):
-            if module.startswith('carton_'):
+        # NOTE: Modules woken up while core modules were loading still take
+        # priority over every core module
+        for name in [n for n in self._modules if n.lstrip('#').split('.')[0] not in core]:
+            self._modules.move_to_end(name)
+            if not name.startswith('#'):
+                self._unregister(name)
+                self._register(name)
+
+        # Load remaining system and repository modules, which could not be
+        # indexed
+        for module, names in plugins.items():
+            if names is None:
                 self.load_from(module)
+        for module, (names, loader) in self._local.items():
+            if names is None:
+                self.load_from(loader())
+
+    def _index(self, module, names):
+        self._pending[module] = names
+        for kind, dormant in self._dormant.items():
+            for name in names[kind]:
+                dormant.setdefault(name, []).append(module)
+
+    def _awaken(self, module):
+        del self._pending[module]
+        if module in self._local:
+            self.load_from(self._local[module][1]())
+        else:
+            self.load_from(module)
 
-        # TODO: Load repository modules
+    def _wake(self, kind, name):
+        for module in self._dormant[kind].pop(name, ()):
+            if module in self._pending:
+                self._awaken(module)
 
     # NOTE: This returns a tuple of (name, instance) for a given module
     def _get_module(self, module):
@@ -101,6 +359,11 @@ class Core:
             raise ValueError(s.MODULE_EXPECTED.format(bad_type=type_name))
 
         if isinstance(module, str):
+            # NOTE: Asking for a dormant system module by name imports it
+            parent = 'carton_' + module.split('.')[0]
+            if parent in self._pending:
+                self._awaken(parent)
+
             loaded = self._modules.get(module, None)
             if None is loaded:
                 loaded = self._modules.get('#' + module, None)
@@ -120,13 +383,44 @@ class Core:
             raise ValueError(s.MODULE_OFFLINE.format(module=name))
 
 
+    # Dispatch registry, updated whenever a module is (un)loaded or toggled
+    def _register(self, name):
+        module = self._modules[name]
+        for identifier in dir(module):
+            value = getattr(module, identifier, None)
+            if not callable(value):
+                continue
+            # NOTE: setdefault keeps the first match in dir() order, which is
+            # what Module.get_hook and Module.get_proc would have returned
+            for hook in getattr(value, '_hooks', ()):
+                handlers = self._hooks.setdefault(hook, collections.OrderedDict())
+                handlers.setdefault(name, value)
+            for proc in getattr(value, '_procs', ()):
+                handlers = self._procs.setdefault(proc, collections.OrderedDict())
+                handlers.setdefault(name, value)
+
+    def _unregister(self, name):
+        for registry in (self._hooks, self._procs):
+            for key, handlers in tuple(registry.items()):
+                handlers.pop(name, None)
+                if len(handlers) == 0:
+                    del registry[key]
+
+
     # Resource loading and unloading
     def load_from(self, module):
+        if self._tracer is not None:
+            name = getattr(module, '__name__', module)
+            return self._tracer.call(
+                'load_from', name, 'load_from', self._load_from, module)
+        return self._load_from(module)
+
+    def _load_from(self, module):
         if isinstance(module, str):
             name = module
             module = importlib.import_module(module)
         elif not isinstance(module, types.ModuleType):
-            type_name = type(m).__name__
+            type_name = type(module).__name__
             message = s.PYTHON_MODULE_EXPECTED.format(bad_type=type_name)
             raise TypeError(message)
         else:
@@ -165,10 +459,17 @@ class Core:
         if parent is not None:
             name = '{parent}.{name}'.format(parent=parent, name=name)
 
+        if self._tracer is not None:
+            return self._tracer.call(
+                'load', name, 'load', self._load, module, name, is_instance)
+        return self._load(module, name, is_instance)
+
+    def _load(self, module, name, is_instance):
         if name in self._modules or ('#' + name) in self._modules:
             raise ValueError(s.MODULE_LOADED.format(module=name))
 
         self._modules[name] = module if is_instance else module(self)
+        self._register(name)
         self.hook('load', _restrict=(name,))
 
     def loaded(self, module=None):
@@ -199,6 +500,7 @@ class Core:
             del self._modules[name]
         elif ('#' + name) in self._modules:
             del self._modules['#' + name]
+        self._unregister(name)
 
 
     # Enabling and disabling of modules, useful for longer-lived processes
@@ -209,6 +511,7 @@ class Core:
         if ('#' + name) in self._modules:
             self._modules[name] = loaded
             del self._modules['#' + name]
+            self._register(name)
             self.hook('enable', _restrict=(name,))
 
     def enabled(self, module=None):
@@ -228,6 +531,7 @@ class Core:
             self.hook('disable', _restrict=(name,))
             self._modules['#' + name] = loaded
             del self._modules[name]
+            self._unregister(name)
 
 
     # Resource ownership, speaking in terms of files in repository
@@ -254,19 +558,41 @@ class Core:
 
 
     # Module queries
-    def hook(self, _name, *args, _filter='latest', _restrict=None, **kwargs):
-        results = collections.OrderedDict()
-        modules = filter(lambda s: not s.startswith('#'), self._modules)
+    def _call_hooks(self, _name, args, kwargs, _filter, _restrict):
+        if _name in self._dormant['hooks']:
+            self._wake('hooks', _name)
+
+        handlers = self._hooks.get(_name, {})
+
+        if callable(_filter) or _filter == 'all':
+            # NOTE: These filters also expect an entry for enabled modules
+            # that do not implement the hook
+            modules = filter(lambda s: not s.startswith('#'), self._modules)
+        else:
+            modules = tuple(handlers)
         if _restrict is not None:
             modules = filter(lambda s: s in _restrict, modules)
 
+        results = collections.OrderedDict()
+        tracer = self._tracer
         for name in modules:
-            f = self._modules[name].get_hook(_name)
-            if callable(f):
+            f = handlers.get(name, None)
+            if not callable(f):
+                results[name] = f
+            elif tracer is None:
                 results[name] = f(*args, **kwargs)
             else:
-                results[name] = f
+                start = time.perf_counter()
+                result = f(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    result = tracer.wait('hook', name, _name, result, start)
+                else:
+                    tracer.record('hook', name, _name, start, time.perf_counter())
+                results[name] = result
 
+        return results
+
+    def _filter_results(self, results, _filter):
         if callable(_filter):
             return _filter(results)
         elif _filter == 'all':
@@ -276,24 +602,89 @@ class Core:
             results = tuple(filter(lambda v: v is not None, results.values()))
             return results[index] if len(results) > 0 else None
 
+    def hook(self, _name, *args, _filter='latest', _restrict=None, **kwargs):
+        results = self._call_hooks(_name, args, kwargs, _filter, _restrict)
+        if any(map(inspect.isawaitable, results.values())):
+            results = _run(_gather(results))
+
+        return self._filter_results(results, _filter)
+
     def proc(self, _name, *args, **kwargs):
-        modules = tuple(filter(lambda s: not s.startswith('#'), self._modules))
-        for name in reversed(modules):
-            f = self._modules[name].get_proc(_name)
-            if callable(f):
-                return f(*args, **kwargs)
+        if _name in self._dormant['procs']:
+            self._wake('procs', _name)
+
+        handlers = self._procs.get(_name, None)
+        if handlers:
+            # NOTE: The latest enabled module takes priority
+            if self._tracer is not None:
+                name, f = next(reversed(handlers.items()))
+                start = time.perf_counter()
+                result = f(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    return _run(self._tracer.wait('proc', name, _name, result, start))
+                self._tracer.record('proc', name, _name, start, time.perf_counter())
+                return result
+
+            result = next(reversed(handlers.values()))(*args, **kwargs)
+            return _run(result) if inspect.isawaitable(result) else result
+
+        raise NameError(s.COMMAND_NOT_FOUND.format(command=_name))
+
+    # NOTE: Synchronous hooks run one after the other, as they are called, and
+    # coroutine hooks then run concurrently
+    async def ahook(self, _name, *args, _filter='latest', _restrict=None, **kwargs):
+        results = self._call_hooks(_name, args, kwargs, _filter, _restrict)
+        return self._filter_results(await _gather(results), _filter)
+
+    async def aproc(self, _name, *args, **kwargs):
+        if _name in self._dormant['procs']:
+            self._wake('procs', _name)
+
+        handlers = self._procs.get(_name, None)
+        if handlers:
+            name, f = next(reversed(handlers.items()))
+            start = time.perf_counter()
+            result = f(*args, **kwargs)
+            if inspect.isawaitable(result):
+                if self._tracer is not None:
+                    result = self._tracer.wait('proc', name, _name, result, start)
+                return await result
+            elif self._tracer is not None:
+                self._tracer.record('proc', name, _name, start, time.perf_counter())
+            return result
 
         raise NameError(s.COMMAND_NOT_FOUND.format(command=_name))
 
 
+    # NOTE: Long-running procs let other sessions in while they wait. Modules
+    # flush their state before the lock is released, and reload it from disk
+    # once it is acquired again, which waits for as long as other sessions
+    # hold it, since modules may not run without it
+    @contextlib.contextmanager
+    def unlocked(self):
+        self.hook('flush')
+        self._lock.release()
+        try:
+            yield
+        finally:
+            self._lock.acquire(wait=True)
+            self.hook('resume')
+
+
     # Exiting Carton
     def shutdown(self):
         for name, module in self._modules.copy().items():
             self.unload(name.lstrip('#'))
 
-        lock = self.state / 'carton.lock'
-        if self._acquired and lock.exists():
-            lock.unlink()
+        if self._acquired:
+            self._lock.release()
+            self._acquired = False
+
+        if self._tracer is not None and self._trace:
+            try:
+                self._tracer.export(self._trace, format='chrome')
+            except OSError:
+                pass
 
     def __del__(self):
         if getattr(self, '_acquired', False):
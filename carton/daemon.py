@@ -0,0 +1,135 @@
+import builtins
+import collections.abc
+import json
+import os
+import signal
+import socket
+import socketserver
+
+from carton.core import Core
+from carton.util import path, strings as s
+
+# NOTE: These procs run for as long as they like, and would keep the daemon
+# from serving anything else
+BLOCKING = ('watch',)
+
+class DaemonUnavailable(ConnectionError):
+    pass
+
+def address(root=None):
+    return path.state(root) / 'carton.sock'
+
+def encode(value):
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    elif isinstance(value, collections.abc.Iterable) and not isinstance(value, str):
+        return list(value)
+    else:
+        return str(value)
+
+def _error(e):
+    return {'type': type(e).__name__, 'message': str(e.args[0] if e.args else e)}
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            kind = request.get('kind', 'proc')
+            if kind == 'stop':
+                response = {'result': None}
+                self.server.stopping = True
+            elif kind == 'proc' and request['name'] in BLOCKING:
+                raise ValueError(s.DAEMON_BLOCKING.format(name=request['name']))
+            elif kind in ('proc', 'hook'):
+                self.server.reload()
+                call = getattr(self.server.core, kind)
+                try:
+                    result = call(
+                        request['name'], *request.get('args', ()),
+                        **request.get('kwargs', {}))
+                finally:
+                    self.server.core.hook('flush')
+                response = {'result': result}
+            else:
+                raise ValueError(s.UNKNOWN_REQUEST.format(kind=kind))
+        except Exception as e:
+            response = {'error': _error(e)}
+
+        data = json.dumps(response, default=encode) + '\n'
+        self.wfile.write(data.encode('utf-8'))
+
+# NOTE: Requests are handled one at a time, on the thread that loaded the Core,
+# so modules never see concurrent calls. The configuration is reloaded before
+# each of them when it changed on disk, and modules flush their state to disk
+# after each of them, so that nothing acknowledged is lost
+class Server(socketserver.UnixStreamServer):
+    def __init__(self, core, address):
+        self.core = core
+        self.stopping = False
+        super().__init__(str(address), _Handler)
+
+    def reload(self):
+        try:
+            self.core.proc('reload')
+        except NameError:
+            pass
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
+def serve(root=None, **kwargs):
+    core = Core(root, **kwargs)
+    socket_path = address(root)
+
+    # NOTE: We hold the exclusive lock, so any socket left there is stale
+    try:
+        socket_path.unlink()
+    except FileNotFoundError:
+        pass
+
+    # NOTE: Termination unwinds like an interrupt, so the Core is shut down
+    terminate = signal.signal(signal.SIGTERM, _terminate)
+    try:
+        # NOTE: The socket is private from the moment it is bound, so that no
+        # other user may connect before its mode could be changed
+        umask = os.umask(0o077)
+        try:
+            server = Server(core, socket_path)
+        finally:
+            os.umask(umask)
+
+        with server:
+            while not server.stopping:
+                server.handle_request()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            socket_path.unlink()
+        except FileNotFoundError:
+            pass
+        core.shutdown()
+
+def request(kind, name=None, *args, root=None, **kwargs):
+    if not hasattr(socket, 'AF_UNIX'):
+        raise DaemonUnavailable(s.DAEMON_UNAVAILABLE)
+
+    message = {'kind': kind, 'name': name, 'args': args, 'kwargs': kwargs}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(address(root)))
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise DaemonUnavailable(s.DAEMON_NOT_RUNNING) from e
+
+        client.sendall((json.dumps(message, default=encode) + '\n').encode('utf-8'))
+        with client.makefile('rb') as f:
+            response = json.loads(f.readline().decode('utf-8'))
+
+    if 'error' in response:
+        error = getattr(builtins, response['error']['type'], None)
+        if not isinstance(error, type) or not issubclass(error, Exception):
+            error = RuntimeError
+        raise error(response['error']['message'])
+
+    return response['result']
@@ -0,0 +1,87 @@
+import argparse
+import sys
+import time
+from concurrent import futures
+
+from carton.core import Core, discover
+from carton.util import path, strings as s
+
+# NOTE: Worker processes are reused across roots, so whatever they import or
+# compile is shared by every root they deploy, and system modules are only
+# discovered once, by the parent
+_plugins = None
+
+def _initialize(plugins):
+    global _plugins
+    _plugins = plugins
+
+def _deploy(root, incremental, workers):
+    result = {'root': root, 'report': None, 'error': None, 'load': 0.0}
+    start = time.perf_counter()
+
+    core = None
+    try:
+        # NOTE: Core would create a missing repository, hiding mistyped roots
+        repository = path.clean(root) / 'repository'
+        if not repository.is_dir():
+            raise FileNotFoundError(s.FILE_NOT_FOUND.format(path=repository))
+
+        core = Core(root, plugins=_plugins)
+        result['load'] = time.perf_counter() - start
+        report = core.proc('unpack', incremental=incremental, workers=workers)
+        result['report'] = dict(report)
+    except Exception as e:
+        result['error'] = '{kind}: {error}'.format(kind=type(e).__name__, error=e)
+    finally:
+        if core is not None:
+            try:
+                core.shutdown()
+            except Exception as e:
+                if result['error'] is None:
+                    result['error'] = '{kind}: {error}'.format(
+                        kind=type(e).__name__, error=e)
+
+    result['elapsed'] = time.perf_counter() - start
+    return result
+
+def deploy(roots, processes=None, incremental=True, workers=None):
+    plugins = discover()
+
+    with futures.ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_initialize,
+            initargs=(plugins,)) as pool:
+        pending = [pool.submit(_deploy, root, incremental, workers) for root in roots]
+        for future in futures.as_completed(pending):
+            yield future.result()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='carton-fleet',
+        description='Unpack many Carton roots from a single process.')
+    parser.add_argument('roots', nargs='+', help='Carton roots to unpack')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+        help='number of worker processes')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+        help='number of threads applying links in each root')
+    parser.add_argument('--full', action='store_true',
+        help='relink every file instead of only the ones that changed')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    succeeded = 0
+    for result in deploy(args.roots, args.processes, not args.full, args.workers):
+        if result['error'] is not None:
+            print(s.FLEET_FAILURE.format(**result), file=sys.stderr)
+        else:
+            print(s.FLEET_SUCCESS.format(**result, **result['report']))
+            succeeded += 1
+
+    print(s.FLEET_SUMMARY.format(
+        succeeded=succeeded,
+        total=len(args.roots),
+        elapsed=time.perf_counter() - start))
+    return 0 if succeeded == len(args.roots) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
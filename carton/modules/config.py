@@ -1,138 +1,795 @@
+import ast
 import collections as co
+import contextlib
 import copy
+import functools
 import getpass
+import hashlib
 import json
+import os
 import platform
 import shutil
 import sys
 from carton.core import hook, Module, proc
-from carton.util import strings as s
+from carton.util import path, strings as s, views
+
+CACHE_VERSION = 1
+FRAGMENTS_VERSION = 1
+
+_MISSING = object()
+
+# NOTE: Compiled conditions only depend on their source, so they are shared by
+# every Core in the process
+_conditions = {}
+
+def _compile(condition):
+    code = _conditions.get(condition, None)
+    if code is None:
+        code = compile(condition, '<condition>', 'eval')
+        _conditions[condition] = code
+    return code
+
+def _memoize(probe):
+    cache = {}
+
+    @functools.wraps(probe)
+    def memoized(*args, **kwargs):
+        try:
+            key = (args, frozenset(kwargs.items()))
+            if key not in cache:
+                cache[key] = probe(*args, **kwargs)
+            return cache[key]
+        except TypeError:
+            # NOTE: Unhashable arguments cannot be cached
+            return probe(*args, **kwargs)
+
+    memoized.cache = cache
+    memoized.cache_clear = cache.clear
+    return memoized
+
+# NOTE: This returns a hashable key made of the values of the given variables
+def _project(environment, names):
+    key = []
+    for name in names:
+        value = environment[name] if name in environment else _MISSING
+        try:
+            hash(value)
+            key.append(value)
+        except TypeError:
+            key.append(repr(value))
+    return tuple(key)
+
+def _normalize(value):
+    return json.loads(json.dumps(value, default=repr))
+
+# NOTE: These are the free variables of a condition, attribute names and the
+# variables its comprehensions bind are not looked up in the environment
+_free = {}
+
+def _names(condition):
+    names = _free.get(condition, None)
+    if names is None:
+        loaded, bound = set(), set()
+        for node in ast.walk(ast.parse(condition, '<condition>', 'eval')):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            elif isinstance(node, ast.Name):
+                bound.add(node.id)
+        names = _free[condition] = frozenset(loaded - bound)
+    return names
+
+# NOTE: These are the top-level keys a database may define, in itself or in
+# any of its patches
+def _keys(database, keys=None):
+    if keys is None:
+        keys = set()
+
+    keys.update(k for k in database if k not in ('if', 'patch'))
+    for patch in database.get('patch', []):
+        if isinstance(patch, co.abc.MutableMapping):
+            _keys(patch, keys)
+
+    return keys
+
+# NOTE: Fragments from carton.d/ are merged after carton.json, as if they were
+# its last patches. A fragment is only parsed when a key it defines is needed
+# and its guard matches, its keys and guard being otherwise known from the
+# state as long as its mtime and size did not change
+class Fragment:
+    def __init__(self, file, stat, description=None):
+        self.file = file
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.patches = None
+        self.dirty = False
+        self._data = None
+
+        if description is not None:
+            self.keys = frozenset(description['keys'])
+            self.guard = description['if']
+        else:
+            self.keys = frozenset(_keys(self.data))
+
+    def matches(self, stat):
+        return self.mtime == stat.st_mtime_ns and self.size == stat.st_size
+
+    @property
+    def data(self):
+        if self._data is None:
+            try:
+                with open(str(self.file), 'rb') as f:
+                    self._data = json.loads(f.read().decode('utf-8'))
+                if not isinstance(self._data, co.abc.MutableMapping):
+                    raise ValueError(self._data)
+            except ValueError:
+                print(s.CORRUPT_FILE.format(file=self.file), file=sys.stderr)
+                self.file.rename(self.file.with_suffix('.json.bak'))
+                self._data = {}
+            self.guard = self._data.get('if', 'True')
+        return self._data
+
+    def describe(self):
+        return {
+            'mtime': self.mtime,
+            'size': self.size,
+            'keys': sorted(self.keys),
+            'if': self.guard
+        }
+
+    def save(self):
+        path.write(self.file, json.dumps(self._data, indent=2))
+        stat = self.file.stat()
+        self.mtime, self.size = stat.st_mtime_ns, stat.st_size
+        self.dirty = False
+
+# NOTE: Variables are only computed when a condition refers to them, and then
+# kept for as long as the environment lives. They are looked up, in order, from
+# 'environment.<name>' hooks, from the results of the 'update_environment' hook,
+# which is only fired once a variable is not provided by the former, and from
+# the given providers, which plugins may thus override
+class Environment(co.abc.Mapping):
+    def __init__(self, module, providers):
+        self._module = module
+        self._providers = dict(providers)
+        self._values = {}
+        self._missing = set()
+        self._fallback = None
+
+    def _resolve(self, name):
+        if name in self._values:
+            return True
+        elif name in self._missing:
+            return False
+
+        value = self._module.hook('environment.' + name)
+        if value is None:
+            if self._fallback is None:
+                self._fallback = {}
+                for env in self._module.hook('update_environment', _filter="all").values():
+                    try:
+                        self._fallback.update(env)
+                    except:
+                        pass
+            if name in self._fallback:
+                value = self._fallback[name]
+            elif name in self._providers:
+                value = self._providers[name]()
+            else:
+                self._missing.add(name)
+                return False
+
+        # NOTE: Probes are memoized for as long as this environment lives
+        self._values[name] = _memoize(value) if callable(value) else value
+        return True
+
+    def __contains__(self, name):
+        return self._resolve(name)
+
+    def __getitem__(self, name):
+        if not self._resolve(name):
+            raise KeyError(name)
+        return self._values[name]
+
+    def __iter__(self):
+        return iter(tuple(self._values))
+
+    def __len__(self):
+        return len(self._values)
+
+    # NOTE: Fingerprints record the variables resolved so far, or the calls
+    # made for memoized probes, in a form that survives JSON
+    def fingerprint(self):
+        fingerprint = {name: {'missing': True} for name in self._missing}
+        for name, value in self._values.items():
+            calls = getattr(value, 'cache', None)
+            if calls is not None:
+                fingerprint[name] = {'calls': [
+                    [list(args), dict(kwargs), result]
+                    for (args, kwargs), result in calls.items()
+                ]}
+            else:
+                fingerprint[name] = {'value': value}
+
+        return _normalize(fingerprint)
+
+    def matches(self, fingerprint):
+        for name, expected in fingerprint.items():
+            if expected.get('missing', False):
+                if name in self:
+                    return False
+            elif name not in self:
+                return False
+            elif 'calls' in expected:
+                probe = self[name]
+                for args, kwargs, result in expected['calls']:
+                    if _normalize(probe(*args, **kwargs)) != result:
+                        return False
+            elif _normalize(self[name]) != expected['value']:
+                return False
+
+        return True
 
 class ConfigModule(Module):
-    environment = {
-        'which': shutil.which,
-        'host': platform.node(),
-        'user': getpass.getuser(),
-        'platform': platform.system()
+    providers = {
+        'which': lambda: shutil.which,
+        'host': platform.node,
+        'user': getpass.getuser,
+        'platform': platform.system
     }
+    fragments = ()
 
-    def _patch(self, database, patch):
-        if not isinstance(database, co.abc.MutableMapping):
+    # NOTE: Merging is copy-on-write, containers that come from the database
+    # are only copied once a patch actually modifies them, and every container
+    # created in the process is tracked in owned, keyed by id()
+    def _patch(self, database, patch, owned=None):
+        if not isinstance(database, co.abc.Mapping):
             raise ValueError(s.WRONG_TYPE.format(
-                expected="a mutable mapping",
+                expected="a mapping",
                 bad_type=type(database).__name__
             ))
-        elif not isinstance(patch, co.Mapping):
+        elif not isinstance(patch, co.abc.Mapping):
             raise ValueError(s.WRONG_TYPE.format(
                 expected="a mapping",
                 bad_type=type(patch).__name__
             ))
 
+        if owned is None:
+            owned = {}
+        if id(database) not in owned:
+            database = dict(database)
+            owned[id(database)] = database
+
         for key, value in patch.items():
-            if isinstance(value, co.Mapping):
-                database[key] = self._patch(database.get(key, {}), value)
-            elif isinstance(value, co.Iterable) and not isinstance(value, str):
-                orig = database.setdefault(key, [])
-                if not isinstance(orig, co.MutableSequence):
-                    database[key] = orig = [orig]
+            if isinstance(value, co.abc.Mapping):
+                database[key] = self._patch(database.get(key, {}), value, owned)
+            elif isinstance(value, co.abc.Iterable) and not isinstance(value, str):
+                orig = database.get(key, [])
+                if not isinstance(orig, co.abc.MutableSequence):
+                    orig = [orig]
+                if id(orig) not in owned:
+                    orig = list(orig)
+                    owned[id(orig)] = orig
                 orig.extend(value)
+                database[key] = orig
             else:
                 database[key] = value
 
         return database
-    
-    def _reduce(self, database, environment):
+
+    # NOTE: When keys is given, only these top-level keys are reduced, which is
+    # enough to refresh them since patches are always merged from the root
+    def _test(self, condition, environment):
+        try:
+            code = _compile(condition)
+            scope = {n: environment[n] for n in _names(condition) if n in environment}
+            return bool(eval(code, {'__builtins__': {}}, scope))
+        except Exception:
+            print(s.CONDITION_CRASH.format(condition=condition), file=sys.stderr)
+            return False
+
+    # NOTE: When matched is given, it holds the id() of every patch to apply,
+    # and conditions are not evaluated at all
+    def _reduce(self, database, environment, owned=None, keys=None, matched=None):
         if not isinstance(database, co.abc.MutableMapping):
             return database
 
+        if matched is not None:
+            if id(database) not in matched:
+                return {}
+        elif not self._test(database.get('if', 'True'), environment):
+            return {}
+
+        # NOTE: Only this level is copied, values are shared with the database
+        if owned is None:
+            owned = {}
+        reduced = {k: v for k, v in database.items() if k not in ('if', 'patch')}
+        if keys is not None:
+            reduced = {k: v for k, v in reduced.items() if k in keys}
+        owned[id(reduced)] = reduced
+        for patch in database.get('patch', []):
+            patch = self._reduce(patch, environment, owned, keys, matched)
+            reduced = self._patch(reduced, patch, owned)
+
+        return reduced
+
+    # NOTE: This maps condition chains, as accepted by set, to their patch
+    def _index(self, database, index=None, chain=()):
+        if index is None:
+            index = {}
+
+        for patch in database.get('patch', []):
+            if not isinstance(patch, co.abc.MutableMapping):
+                continue
+
+            key = chain + (patch.get('if', None),)
+            if key not in index:
+                index[key] = patch
+                self._index(patch, index, key)
+
+        return index
+
+    # NOTE: Refreshed keys lose what fragments merged into them, and are
+    # merged again once requested
+    def _refresh(self):
+        stale, self._stale = self._stale, set()
+        if stale is None:
+            self.base = self._reduce(self._database(), self.environment)
+            self.local = self.base
+            self._pending = set(self._provided)
+        elif len(stale) != 0:
+            reduced = self._reduce(self._database(), self.environment, keys=stale)
+            base, local = dict(self.base), dict(self.local)
+            for key in stale:
+                if key in reduced:
+                    base[key] = local[key] = reduced[key]
+                else:
+                    base.pop(key, None)
+                    local.pop(key, None)
+            self.base, self.local = base, local
+            self._pending.update(stale & self._provided)
+
+    # NOTE: With key, only fragments defining it are merged, and every pending
+    # key is merged otherwise
+    def _merge(self, key=None):
+        if key is None:
+            keys, self._pending = self._pending, set()
+        elif key in self._pending:
+            keys = {key}
+            self._pending.discard(key)
+        else:
+            return
+
+        owned = {}
+        local = self.local
+        for fragment in self.fragments:
+            covered = keys & fragment.keys
+            if len(covered) != 0 and self._test(fragment.guard, self.environment):
+                reduced = self._reduce(fragment.data, self.environment, keys=covered)
+                local = self._patch(local, reduced, owned)
+        self.local = local
+
+    def _combined(self):
+        database = self._database()
+        if len(self.fragments) == 0:
+            return database
+
+        patches = list(database.get('patch', []))
+        patches.extend(fragment.data for fragment in self.fragments)
+        return dict(database, patch=patches)
+
+    # NOTE: This records, for every environment in members, the id() of every
+    # patch it matches. Each condition is evaluated once per distinct set of
+    # values of the variables it refers to, across every environment
+    def _match(self, database, members, environments, matches, results):
         condition = database.get('if', 'True')
         try:
-            if not eval(condition, {'__builtins__': {}}, environment):
-                return {}
+            names = sorted(_names(condition))
         except Exception:
-            print(s.CONDITION_CRASH.format(condition=condition), file=sys.stderr)
+            names = ()
+
+        passing = []
+        for i in members:
+            environment = environments[i]
+            key = (condition,) + _project(environment, names)
+            if key not in results:
+                results[key] = self._test(condition, environment)
+            if results[key]:
+                matches[i].append(id(database))
+                passing.append(i)
+
+        if len(passing) != 0:
+            for patch in database.get('patch', []):
+                if isinstance(patch, co.abc.MutableMapping):
+                    self._match(patch, passing, environments, matches, results)
+
+    def _variables(self, database, names):
+        try:
+            names.update(_names(database.get('if', 'True')))
+        except Exception:
+            pass
+
+        for patch in database.get('patch', []):
+            if isinstance(patch, co.abc.MutableMapping):
+                self._variables(patch, names)
+
+        return names
+
+    # NOTE: Environments matching the same patches share their configuration,
+    # which also shares its containers with the database, so it is returned as
+    # a view. Grouped results list these configurations along with the indexes
+    # of the environments that resolve to them
+    @proc
+    def evaluate(self, environments, grouped=False):
+        environments = list(environments)
+        database = self._combined()
+
+        # Environments that agree on every variable used by the conditions are
+        # only matched once
+        names = sorted(self._variables(database, set()))
+        distinct = co.OrderedDict()
+        for i, environment in enumerate(environments):
+            distinct.setdefault(_project(environment, names), []).append(i)
+
+        representatives = [members[0] for members in distinct.values()]
+        matches = {i: [] for i in representatives}
+        self._match(database, representatives, environments, matches, {})
+
+        groups = co.OrderedDict()
+        for members in distinct.values():
+            signature = tuple(matches[members[0]])
+            groups.setdefault(signature, []).extend(members)
+        for members in groups.values():
+            members.sort()
+
+        configurations = {}
+        for signature in groups:
+            configurations[signature] = views.view(self._reduce(
+                database, None, matched=frozenset(signature)) \
+                if len(signature) != 0 else {})
+
+        if grouped:
+            return [
+                {'environments': members, 'configuration': configurations[signature]}
+                for signature, members in groups.items()
+            ]
+
+        results = [None] * len(environments)
+        for signature, members in groups.items():
+            for i in members:
+                results[i] = configurations[signature]
+        return results
+
+    # NOTE: The database is only parsed once something needs it, which a fresh
+    # cache of the reduced configuration usually avoids. This is a method, as
+    # properties are evaluated whenever modules are scanned for handlers
+    def _database(self):
+        if self._parsed is None:
+            self._parsed = self._parse()
+        return self._parsed
+
+    def _parse(self):
+        if self._source is None:
             return {}
 
-        reduced = copy.deepcopy(database)
-        reduced.pop('if', None)
-        for patch in reduced.pop('patch', []):
-            patch = self._reduce(patch, environment)
-            reduced = self._patch(reduced, patch)
+        try:
+            return json.loads(self._source.decode('utf-8'))
+        except ValueError:
+            print(s.CORRUPT_FILE.format(file=self.config), file=sys.stderr)
+            self.acquire('carton.json.bak')
+            self.config.rename(self.config.with_suffix('.json.bak'))
+            return {}
 
-        return reduced
+    # Reduced configuration cache, valid as long as carton.json is unchanged
+    # and the environment variables used by its conditions are the same
+    def _load_cache(self):
+        try:
+            with self.cache.open() as f:
+                cache = json.load(f)
+            if cache['version'] != CACHE_VERSION or cache['hash'] != self._hash:
+                return None
+            elif not self.environment.matches(cache['environment']):
+                return None
+            return cache['local']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    # NOTE: Fragments kept from a previous load are reused while their file
+    # is unchanged, others are described from the state when possible
+    def _load_fragments(self):
+        try:
+            with self.descriptions.open() as f:
+                cache = json.load(f)
+            if cache['version'] != FRAGMENTS_VERSION:
+                raise ValueError(cache['version'])
+            self._descriptions = dict(cache['fragments'])
+        except (OSError, ValueError, KeyError, TypeError):
+            self._descriptions = {}
+
+        directory = self.repository / 'carton.d'
+        try:
+            entries = sorted(
+                (e for e in os.scandir(str(directory)) if e.name.endswith('.json')),
+                key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            entries = []
+
+        previous = {f.file.name: f for f in self.fragments}
+        fragments = []
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+
+            fragment = previous.get(entry.name, None)
+            if fragment is None or not fragment.matches(stat):
+                description = self._descriptions.get(entry.name, None)
+                try:
+                    if description['mtime'] != stat.st_mtime_ns or \
+                            description['size'] != stat.st_size:
+                        description = None
+                    fragment = Fragment(directory / entry.name, stat, description)
+                except (KeyError, TypeError):
+                    fragment = Fragment(directory / entry.name, stat)
+            fragments.append(fragment)
+
+        return fragments
+
+    def _save_fragments(self):
+        for fragment in self.fragments:
+            if fragment.dirty:
+                fragment.save()
+
+        descriptions = {f.file.name: f.describe() for f in self.fragments}
+        if descriptions != self._descriptions:
+            data = json.dumps({
+                'version': FRAGMENTS_VERSION,
+                'fragments': descriptions
+            }, separators=(',', ':'))
+            try:
+                path.write(self.descriptions, data)
+                self._descriptions = descriptions
+            except OSError:
+                pass
+
+    def _save_cache(self):
+        data = json.dumps({
+            'version': CACHE_VERSION,
+            'hash': self._hash,
+            'environment': self.environment.fingerprint(),
+            'local': self.base
+        }, separators=(',', ':'))
+        try:
+            path.write(self.cache, data)
+            self._cached = True
+        except OSError:
+            pass
 
     @hook
     @hook('enable')
     def on_load(self):
         self.local = {}
+        self._patches = None
+        self._depth = 0
+        self._stale = set()
+        self.dirty = False
 
         self.acquire('carton.json')
+        self.acquire('carton.d')
         self.locked = True
 
         self.config = self.repository / 'carton.json'
+        self.cache = self.state / 'reduced.json'
+        self.descriptions = self.state / 'fragments.json'
+        self._stat = self._stat_config()
         try:
-            with self.config.open() as f:
-                self.database = json.load(f)
+            self._source = self.config.read_bytes()
         except FileNotFoundError:
-            self.database = {}
-        except json.decoder.JSONDecodeError:
-            print(s.CORRUPT_FILE.format(file=self.config), file=sys.stderr)
-            self.acquire('config.json.bak')
-            self.config.rename(self.config.with_suffix('.json.bak'))
-            self.database = {}
+            self._source = None
+        self._hash = hashlib.sha256(self._source or b'').hexdigest()
+        self._parsed = None
+
+        self.fragments = self._load_fragments()
+        self._provided = frozenset().union(*(f.keys for f in self.fragments))
+        self._pending = set(self._provided)
+
+        # NOTE: The base configuration is carton.json alone, fragments are
+        # merged into the local one as needed
+        self.environment = Environment(self, self.providers)
+        self.base = self._load_cache()
+        self._cached = self.base is not None
+        if not self._cached:
+            self.base = self._reduce(self._database(), self.environment)
+        self.local = self.base
 
-        for env in self.hook('update_environment', _filter="all").values():
+    @hook
+    def on_invalidate(self):
+        _conditions.clear()
+        self.environment = Environment(self, self.providers)
+
+        self.base = self._reduce(self._database(), self.environment)
+        self.local = self.base
+        self._pending = set(self._provided)
+        self._cached = False
+
+    def _stat_config(self):
+        try:
+            stat = self.config.stat()
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def _stat_fragments(self):
+        try:
+            entries = os.scandir(str(self.repository / 'carton.d'))
+        except (FileNotFoundError, NotADirectoryError):
+            return {}
+
+        stats = {}
+        for entry in entries:
+            if entry.name.endswith('.json') and entry.is_file():
+                stat = entry.stat()
+                stats[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    # NOTE: Long-running sessions call this to pick up changes made to
+    # carton.json or carton.d/ by others, and it returns whether it reloaded
+    @proc
+    def reload(self):
+        changed = False
+        stat = self._stat_config()
+        if stat != self._stat:
             try:
-                self.environment.update(env)
-            except:
-                pass
-        self.local = self._reduce(self.database, self.environment)
+                source = self.config.read_bytes()
+            except FileNotFoundError:
+                source = None
+            changed = hashlib.sha256(source or b'').hexdigest() != self._hash
+            self._stat = stat
+
+        if not changed:
+            known = {f.file.name: (f.mtime, f.size) for f in self.fragments}
+            changed = known != self._stat_fragments()
+
+        # NOTE: Reloading in place keeps the rank of this module among those
+        # that provide the same procs
+        if changed:
+            self.on_unload()
+            self.on_load()
+        return changed
+
+    def _flush(self):
+        if self.dirty:
+            data = json.dumps(self._database(), indent=2)
+            path.write(self.config, data)
+            self._hash = hashlib.sha256(data.encode('utf-8')).hexdigest()
+            self._stat = self._stat_config()
+            self.dirty = False
+        if not self._cached:
+            self._save_cache()
+        self._save_fragments()
+
+    @hook
+    def on_flush(self):
+        if self.locked:
+            self._flush()
+
+    @hook
+    def on_resume(self):
+        if self.locked:
+            self.reload()
 
     @hook
     @hook('disable')
     def on_unload(self):
         if self.locked:
-            data = json.dumps(self.database, indent=2)
-            with self.config.open('w') as f:
-                f.write(data)
+            self._flush()
 
             self.locked = False
             self.release('carton.json')
+            self.release('carton.d')
             try:
                 self.release('carton.json.bak')
             except ValueError:
                 pass
 
+    # NOTE: Views are read-only proxies over the configuration itself, they are
+    # cheap to make but are not snapshots, use their copy() method if needed
     @proc
-    def get(self, *keys, raw=False):
-        result = self.database if raw else self.local
+    def get(self, *keys, raw=False, view=False):
+        if raw:
+            result = self._combined()
+        else:
+            self._merge(keys[0] if len(keys) != 0 else None)
+            result = self.local
+
         for i, key in enumerate(keys):
             result = result.get(key, None)
-            if not isinstance(result, co.Mapping) and i < len(keys) - 1:
+            if not isinstance(result, co.abc.Mapping) and i < len(keys) - 1:
                 return None
 
-        return copy.deepcopy(result)
+        return views.view(result) if view else copy.deepcopy(result)
+
+    # NOTE: Sets made within a transaction are only reduced once it ends
+    @proc
+    @contextlib.contextmanager
+    def transaction(self):
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self._refresh()
+
+    def _defines(self, database, patches, keys, condition=None):
+        if condition:
+            database = patches.get(tuple(condition), None)
+
+        for key in keys:
+            if not isinstance(database, co.abc.Mapping) or key not in database:
+                return False
+            database = database[key]
+        return True
 
     @proc
     def set(self, *keys, value, condition=None):
-        if not isinstance(condition, co.Iterable) and condition is not None:
+        if self.readonly:
+            raise PermissionError(s.READ_ONLY)
+        if not isinstance(condition, co.abc.Iterable) and condition is not None:
             return None
         elif isinstance(condition, str):
             condition = (condition,)
 
-        database = self.database
-        if condition:
-            for c in condition:
-                patches = database.setdefault('patch', [])
-                patch = list(filter(lambda p: p.get('if', None) == c, patches))
-                if len(patch) != 0:
-                    database = patch[0]
-                else:
-                    database = {'if': c}
-                    patches.append(database)
+        # NOTE: Paths defined by a matching fragment, under the same condition
+        # chain, are written to the last such fragment, and everything else to
+        # carton.json
+        owner = None
+        if keys[0] not in ('if', 'patch'):
+            for fragment in reversed(self.fragments):
+                if keys[0] not in fragment.keys or \
+                        not self._test(fragment.guard, self.environment):
+                    continue
+                if fragment.patches is None:
+                    fragment.patches = self._index(fragment.data)
+                if self._defines(fragment.data, fragment.patches, keys, condition):
+                    owner = fragment
+                    break
+
+        if owner is None:
+            database = self._database()
+            if self._patches is None:
+                self._patches = self._index(database)
+            patches = self._patches
+        else:
+            if owner.patches is None:
+                owner.patches = self._index(owner.data)
+            database, patches = owner.data, owner.patches
+
+        chain = ()
+        for c in condition or ():
+            chain += (c,)
+            patch = patches.get(chain, None)
+            if patch is None:
+                patch = {'if': c}
+                database.setdefault('patch', []).append(patch)
+                patches[chain] = patch
+            database = patch
 
         for i, key in enumerate(keys[:-1]):
             database = database.setdefault(key, {})
 
         database[keys[-1]] = value
-        self.local = self._reduce(self.database, self.environment)
+        if owner is None:
+            self.dirty = True
+            self._cached = False
+        else:
+            owner.dirty = True
+
+        # NOTE: Conditions and patch lists may affect every key
+        if keys[0] in ('if', 'patch'):
+            self._patches = None
+            self._stale = None
+        elif self._stale is not None:
+            self._stale.add(keys[0])
+
+        if self._depth == 0:
+            self._refresh()
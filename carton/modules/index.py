@@ -0,0 +1,188 @@
+import collections as co
+import json
+import os
+from concurrent import futures
+from carton.core import hook, Module, proc
+from carton.util import files as files_, path, strings as s
+
+INDEX_VERSION = 1
+
+def _under(name, references):
+    while name:
+        if name in references:
+            return True
+        name = os.path.dirname(name)
+    return False
+
+# NOTE: The index maps every file in refs/, relative to it, to its mtime, size
+# and content hash, and keeps the hashes of the last successful unpack, which
+# are what status compares the tree against
+class IndexModule(Module):
+    workers = None
+
+    @hook
+    @hook('enable')
+    def on_load(self):
+        self.acquire('refs.json')
+        self.locked = True
+
+        self.index = self.state / 'refs.json'
+        self.files, self.deployed = {}, {}
+        self.dirty = False
+        try:
+            with self.index.open() as f:
+                index = json.load(f)
+            if index['version'] == INDEX_VERSION:
+                self.files = {k: tuple(v) for k, v in index['files'].items()}
+                self.deployed = dict(index['deployed'])
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError, AttributeError):
+            print(s.CORRUPT_FILE.format(file=self.index))
+            self.files, self.deployed = {}, {}
+            self.dirty = True
+
+    def _save(self):
+        if self.dirty:
+            data = json.dumps({
+                'version': INDEX_VERSION,
+                'files': self.files,
+                'deployed': self.deployed
+            }, separators=(',', ':'))
+            try:
+                path.write(self.index, data)
+                self.dirty = False
+            except OSError:
+                pass
+
+    @hook
+    def on_flush(self):
+        if getattr(self, 'locked', False):
+            self._save()
+
+    @hook
+    def on_resume(self):
+        if getattr(self, 'locked', False):
+            self.on_unload()
+            self.on_load()
+
+    @hook
+    @hook('disable')
+    def on_unload(self):
+        if getattr(self, 'locked', False):
+            self._save()
+
+            self.locked = False
+            self.release('refs.json')
+
+    def _scan(self, directory, prefix, found):
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return
+        except PermissionError:
+            raise PermissionError(s.PERMISSION_ERROR.format(path=directory))
+
+        for entry in entries:
+            name = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                self._scan(entry.path, name + os.sep, found)
+            elif entry.is_file():
+                stat = entry.stat()
+                found[name] = (entry.path, stat.st_mtime_ns, stat.st_size)
+
+    # NOTE: Only files whose mtime or size changed since the last refresh are
+    # read again, and those are hashed by a thread pool
+    def _refresh(self):
+        found = {}
+        self._scan(str(self.repository / 'refs'), '', found)
+
+        files, changed = {}, []
+        for name, (file, mtime, size) in found.items():
+            known = self.files.get(name, None)
+            if known is not None and known[0] == mtime and known[1] == size:
+                files[name] = known
+            else:
+                changed.append((name, file, mtime, size))
+
+        if len(changed) > 1 and self.workers != 1:
+            with futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                hashes = pool.map(files_.digest, [file for _, file, _, _ in changed])
+                hashes = list(hashes)
+        else:
+            hashes = [files_.digest(file) for _, file, _, _ in changed]
+
+        for (name, file, mtime, size), digest in zip(changed, hashes):
+            files[name] = (mtime, size, digest)
+
+        if len(changed) != 0 or len(files) != len(self.files):
+            self.files = files
+            self.dirty = True
+        return self.files
+
+    @proc
+    def hashes(self, reference=None):
+        files = self._refresh()
+        if reference is None:
+            return {name: entry[2] for name, entry in files.items()}
+
+        reference = os.path.normpath(reference)
+        return {
+            name: entry[2] for name, entry in files.items()
+            if name == reference or name.startswith(reference + os.sep)
+        }
+
+    @hook
+    def on_unpacked(self, report):
+        self.deployed = self.proc('hashes')
+        self.dirty = True
+
+    # NOTE: Refs are compared to the last unpack, and links from the packer's
+    # database are dangling when their target or reference disappeared, and
+    # foreign when their target is no longer what Carton deployed there
+    @proc
+    def status(self):
+        hashes = self.proc('hashes')
+        refs = self.repository / 'refs'
+        inside = str(refs) + os.sep
+
+        files = self.proc('get', 'install', view=True) or {}
+        if not isinstance(files, co.abc.Mapping):
+            raise TypeError(s.INVALID_CONFIGURATION.format(element='install'))
+        references = {
+            os.path.normpath(files_.entry(value)[0]) for value in files.values()
+        }
+
+        status = co.OrderedDict((
+            ('new', []), ('modified', []), ('deleted', []), ('orphaned', []),
+            ('dangling', []), ('foreign', [])
+        ))
+        for name, digest in hashes.items():
+            known = self.deployed.get(name, None)
+            if known is None:
+                status['new'].append(name)
+            elif known != digest:
+                status['modified'].append(name)
+            if not _under(name, references):
+                status['orphaned'].append(name)
+        status['deleted'] = [name for name in self.deployed if name not in hashes]
+
+        links = self.proc('links', details=True)
+        for file, (reference, mode, hash, mtime, size) in links.items():
+            target = str(path.clean(file, resolve=False))
+            origin = str(refs / reference)
+            if not os.path.lexists(target) or not os.path.exists(origin):
+                status['dangling'].append(file)
+            elif mode == 'symlink':
+                if not os.path.realpath(target).startswith(inside):
+                    status['foreign'].append(file)
+            elif os.path.islink(target) or not os.path.isfile(target):
+                status['foreign'].append(file)
+            elif mode == 'hardlink' and os.path.samefile(target, origin):
+                continue
+            elif not files_.intact(target, hash, size, mtime):
+                status['foreign'].append(file)
+
+        for names in status.values():
+            names.sort()
+        return status
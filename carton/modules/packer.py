@@ -1,69 +1,368 @@
 import collections as co
-import json
+import functools
 import os
+from concurrent import futures
 from carton.core import hook, Module, proc
-from carton.util import path, strings as s
+from carton.util import files as files_, path, store, strings as s
+
+Operation = co.namedtuple(
+    'Operation', ('action', 'file', 'target', 'reference', 'change', 'mode', 'hash'),
+    defaults=('symlink', None))
+
+class UnpackError(OSError):
+    def __init__(self, errors, report):
+        details = ''.join(
+            '\n  {target}: {error}'.format(target=o.target, error=e)
+            for o, e in errors)
+        message = s.UNPACK_FAILED.format(count=len(errors), details=details)
+        super().__init__(message)
+        self.errors = errors
+        self.report = report
 
 class PackerModule(Module):
     @hook
     @hook('enable')
     def on_load(self):
-        self.acquire('links.json')
+        # NOTE: The state backend and its format come from the configuration
+        try:
+            compact = bool(self.proc('get', 'compact'))
+            backend = store.backend(self.proc('get', 'backend'))
+        except NameError:
+            compact = False
+            backend = store.backend()
+
+        self.acquire(backend.filename)
         self.locked = True
 
-        self.links = self.state / 'links.json'
+        self.links_file = self.state / backend.filename
         try:
-            with self.links.open() as f:
-                self.database = json.load(f)
-        except FileNotFoundError:
-            self.database = {}
-        except json.decoder.JSONDecodeError:
-            print(s.CORRUPT_FILE.format(file=self.links))
-            self.acquire('links.json.bak')
-            self.links.rename(self.links.with_suffix('.json.bak'))
-            self.database = {}
+            self.database = backend(self.links_file, compact=compact)
+        except ValueError:
+            print(s.CORRUPT_FILE.format(file=self.links_file))
+            self.acquire(backend.filename + '.bak')
+            self.links_file.rename(self.links_file.with_name(backend.filename + '.bak'))
+            self.database = backend(self.links_file, compact=compact)
+
+        # Migrate links from older JSON states, which read-only sessions may
+        # not do, so they read the older state as it is instead
+        legacy = self.state / store.JSONStore.filename
+        if backend is not store.JSONStore and legacy.exists() and self.readonly:
+            try:
+                links = store.JSONStore(legacy)
+                self.database.close()
+                self.database = links
+            except ValueError:
+                # NOTE: The next writable session reports and moves it
+                pass
+        elif backend is not store.JSONStore and legacy.exists():
+            self.acquire(legacy.name)
+            try:
+                links = store.JSONStore(legacy)
+                for file, entry in links.entries().items():
+                    self.database.record(file, *entry)
+                self.database.close()
+                self.database = backend(self.links_file, compact=compact)
+                legacy.unlink()
+            except ValueError:
+                print(s.CORRUPT_FILE.format(file=legacy))
+                legacy.rename(legacy.with_name(legacy.name + '.bak'))
+            self.release(legacy.name)
+
+    @hook
+    def on_flush(self):
+        if getattr(self, 'locked', False):
+            self.database.commit()
+
+    @hook
+    def on_resume(self):
+        if getattr(self, 'locked', False):
+            self.on_unload()
+            self.on_load()
 
     @hook
     @hook('disable')
     def on_unload(self):
         if getattr(self, 'locked', False):
-            data = json.dumps(self.database, indent=2)
-            with self.links.open('w') as f:
-                f.write(data)
+            self.database.close()
 
             self.locked = False
-            self.release('links.json')
+            self.release(self.links_file.name)
             try:
-                self.release('links.json.bak')
+                self.release(self.links_file.name + '.bak')
             except ValueError:
                 pass
 
+    # NOTE: With details, links map to their reference, mode and hash, and to
+    # the mtime and size recorded for real files
     @proc
-    def unpack(self):
-        files = self.proc('get', 'install') or {}
-        if not isinstance(files, co.Mapping):
+    def links(self, reference=None, directory=None, details=False):
+        if reference is not None:
+            links = self.database.by_reference(reference)
+        else:
+            links = dict(self.database)
+
+        if directory is not None:
+            found = self.database.by_directory(directory)
+            links = {k: v for k, v in links.items() if k in found}
+
+        if details:
+            entries = self.database.entries()
+            links = {k: entries[k] for k in links}
+        return links
+
+    # NOTE: Symlinks belong to Carton when they point into refs/, real files
+    # when the database recorded them as deployed in another mode and they
+    # still hold what was deployed, hardlinks being also recognised as their
+    # reference once it changed. The entry scanned by the planner, if any,
+    # spares further lookups of the target
+    def _owned(self, file, target, entry=None):
+        if entry is not None:
+            symlink = entry.is_symlink()
+            regular = not symlink and entry.is_file(follow_symlinks=False)
+        else:
+            symlink = os.path.islink(target)
+            regular = not symlink and os.path.isfile(target)
+
+        if symlink:
+            inside = str(self.repository / 'refs') + os.sep
+            return os.readlink(target).startswith(inside)
+        elif not regular:
+            return False
+
+        try:
+            reference, mode, hash, mtime, size = self.database.entry(file)
+        except KeyError:
+            return False
+
+        if mode == 'hardlink':
+            origin = str(self.repository / 'refs' / reference)
+            try:
+                if os.path.samefile(target, origin):
+                    return True
+            except OSError:
+                pass
+        return mode != 'symlink' and files_.intact(target, hash, size, mtime)
+
+    # Planning, which inspects every target directory only once
+    def _scan(self, directory):
+        try:
+            return {entry.name: entry for entry in os.scandir(directory)}
+        except FileNotFoundError:
+            return None
+        except NotADirectoryError:
+            raise NotADirectoryError(s.NOT_A_DIRECTORY.format(path=directory))
+        except PermissionError:
+            raise PermissionError(s.PERMISSION_ERROR.format(path=directory))
+
+    # NOTE: A plan is an ordered list of operations, directories come first,
+    # then links, grouped by directory, and finally removals
+    @proc
+    def plan(self, incremental=False):
+        files = self.proc('get', 'install', view=True) or {}
+        if not isinstance(files, co.abc.Mapping):
             raise TypeError(s.INVALID_CONFIGURATION.format(element='install'))
 
-        for file, reference in files.items():
-            self.proc('can_link', reference, file)
+        refs = self.repository / 'refs'
+        deployments = {file: files_.entry(value) for file, value in files.items()}
+        hashes = None
+
+        groups = co.OrderedDict()
+        targets = {}
+        for file in files:
+            target = path.clean(file, resolve=False)
+            groups.setdefault(str(target.parent), []).append((file, target.name))
+
+            # NOTE: Targets may not overlap, nor be nested in one another
+            if target in targets:
+                raise FileExistsError(s.CONFLICTING_TARGETS.format(
+                    file=file, other=targets[target]))
+            targets[target] = file
 
-        for file, reference in files.items():
-            self.proc('link', reference, file)
-            self.database[file] = reference
+        for target, file in targets.items():
+            for parent in target.parents:
+                if parent in targets:
+                    raise FileExistsError(s.CONFLICTING_TARGETS.format(
+                        file=file, other=targets[parent]))
 
-        # We cleanup dead shortcuts and invalid ones
-        for file in self.database.keys():
+        for file in self.database:
             if file not in files:
-                self.proc('unlink', file)
+                target = path.clean(file, resolve=False)
+                groups.setdefault(str(target.parent), []).append((file, target.name))
+
+        directories, links, removals = [], [], []
+        for directory, members in groups.items():
+            entries = self._scan(directory)
+            if entries is None and any(file in files for file, name in members):
+                directories.append(Operation('mkdir', None, directory, None, None))
+            elif entries is not None and not os.access(directory, os.W_OK):
+                raise PermissionError(s.PERMISSION_ERROR.format(path=directory))
+
+            for file, name in members:
+                target = os.path.join(directory, name)
+                entry = entries.get(name, None) if entries is not None else None
+                owned = entry is None or self._owned(file, target, entry)
+
+                if file not in files:
+                    if entry is None:
+                        removals.append(Operation('forget', file, target, None, 'removed'))
+                    elif not owned:
+                        raise FileExistsError(s.FILE_NOT_TRACKED.format(path=target))
+                    else:
+                        removals.append(Operation('unlink', file, target, None, 'removed'))
+                    continue
+
+                reference, mode = deployments[file]
+                origin = str(refs / reference)
+                if not os.path.exists(origin):
+                    raise FileNotFoundError(s.FILE_NOT_FOUND.format(path=origin))
+                elif mode != 'symlink' and not os.path.isfile(origin):
+                    raise IsADirectoryError(s.NOT_A_FILE.format(path=origin, mode=mode))
+                elif not owned:
+                    raise FileExistsError(s.FILE_EXISTS.format(path=target))
+
+                try:
+                    known = self.database.entry(file)
+                except KeyError:
+                    known = None
+
+                # NOTE: Deployments are only skipped in incremental mode, and
+                # owned copies are known to be intact by now. Copies recorded
+                # without their mtime are deployed again to record it
+                hash = None
+                if mode in ('reflink', 'copy', 'hardlink'):
+                    if hashes is None:
+                        hashes = self._hashes()
+                    hash = hashes(reference)
+
+                same = incremental and known is not None and \
+                    known[:3] == (reference, mode, hash) and entry is not None
+                if mode == 'symlink':
+                    same = same and entry.is_symlink() and \
+                        os.readlink(target) == origin
+                elif mode == 'hardlink':
+                    same = same and os.path.samefile(target, origin)
+                else:
+                    same = same and entry.is_file(follow_symlinks=False) and \
+                        known[3] is not None
+                if same:
+                    continue
+
+                action = 'link' if entry is None else 'relink'
+                change = 'added' if known is None else 'changed'
+                links.append(Operation(
+                    action, file, target, reference, change, mode, hash))
+
+        directories.sort(key=lambda operation: operation.target)
+        return directories + links + removals
+
+    # NOTE: Hashes come from the refs index when it is loaded, and are
+    # otherwise computed once per reference
+    def _hashes(self):
+        refs = self.repository / 'refs'
+        try:
+            index = self.proc('hashes')
+        except NameError:
+            index = {}
+
+        @functools.lru_cache(None)
+        def hashes(reference):
+            hash = index.get(os.path.normpath(reference), None)
+            return hash if hash is not None else files_.digest(refs / reference)
+        return hashes
+
+    # NOTE: Only touches the filesystem, so that it may run in worker threads.
+    # Real files replace their target atomically, symlinks are removed first
+    def _execute(self, operation):
+        if operation.action == 'mkdir':
+            os.makedirs(operation.target, exist_ok=True)
+            return
+
+        if operation.action == 'unlink' or \
+                (operation.action == 'relink' and operation.mode == 'symlink'):
+            os.unlink(operation.target)
+        if operation.action in ('link', 'relink'):
+            origin = self.repository / 'refs' / operation.reference
+            files_.deploy(operation.mode, origin, operation.target)
+
+    # NOTE: Real files are recorded with their mtime and size once deployed, so
+    # that they are only hashed again after they changed
+    def _record(self, operation):
+        if operation.action in ('link', 'relink'):
+            mtime, size = None, None
+            if operation.mode != 'symlink':
+                try:
+                    stat = os.stat(operation.target)
+                    mtime, size = stat.st_mtime_ns, stat.st_size
+                except OSError:
+                    pass
+            self.database.record(
+                operation.file, operation.reference, operation.mode, operation.hash,
+                mtime, size)
+        elif operation.action in ('unlink', 'forget'):
+            del self.database[operation.file]
+
+    # NOTE: With workers, links are applied by a bounded thread pool once every
+    # directory exists, and the database is only updated from this thread
+    @proc
+    def unpack(self, incremental=False, workers=None):
+        if self.readonly:
+            raise PermissionError(s.READ_ONLY)
+        plan = self.proc('plan', incremental)
+
+        report = co.OrderedDict((
+            ('added', 0), ('changed', 0), ('removed', 0), ('unchanged', 0)
+        ))
+        errors = []
+
+        def done(operation, error=None):
+            if error is not None:
+                errors.append((operation, error))
+                return
+
+            self._record(operation)
+            if operation.change is not None:
+                report[operation.change] += 1
+
+        directories = [o for o in plan if o.action == 'mkdir']
+        for operation in directories:
+            try:
+                self._execute(operation)
+                done(operation)
+            except OSError as e:
+                done(operation, e)
+
+        operations = [o for o in plan if o.action != 'mkdir']
+        if workers is None or workers <= 1:
+            for operation in operations:
+                try:
+                    self._execute(operation)
+                    done(operation)
+                except OSError as e:
+                    done(operation, e)
+        else:
+            with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = {pool.submit(self._execute, o): o for o in operations}
+                for future in futures.as_completed(pending):
+                    done(pending[future], future.exception())
+
+        files = self.proc('get', 'install', view=True) or {}
+        report['unchanged'] = len(files) - report['added'] - report['changed']
+        report['unchanged'] -= len(
+            [o for o, e in errors if o.change in ('added', 'changed')])
+
+        if len(errors) != 0:
+            raise UnpackError(errors, report)
+        self.hook('unpacked', report)
+        return report
 
     @proc
     def can_link(self, reference, file):
+        name = file
         file = path.clean(file, resolve=False)
         origin = self.repository / 'refs' / reference
-        source = file.resolve()
         if not origin.exists():
             raise FileNotFoundError(s.FILE_NOT_FOUND.format(path=origin))
-        elif file.exists() and (self.repository / 'refs') not in source.parents:
+        elif file.exists() and not self._owned(name, str(file)):
             raise FileExistsError(s.FILE_EXISTS.format(path=file))
         elif file.parent.exists() and not file.parent.is_dir():
             raise NotADirectoryError(s.NOT_A_DIRECTORY.format(path=file.parent))
@@ -71,25 +370,33 @@ class PackerModule(Module):
             raise PermissionError(s.PERMISSION_ERROR.format(path=file.parent))
 
     @proc
-    def link(self, reference, file):
+    def link(self, reference, file, mode='symlink'):
+        if self.readonly:
+            raise PermissionError(s.READ_ONLY)
         file = path.clean(file, resolve=False)
         origin = self.repository / 'refs' / reference
+        if mode not in files_.MODES:
+            raise ValueError(s.UNKNOWN_MODE.format(mode=mode))
+        elif mode != 'symlink' and not origin.is_file():
+            raise IsADirectoryError(s.NOT_A_FILE.format(path=origin, mode=mode))
 
         if not file.parent.exists():
             file.parent.mkdir(parents=True)
-        if file.exists():
+        if file.exists() and mode == 'symlink':
             file.unlink()
-        file.symlink_to(origin, target_is_directory=origin.is_dir())
+        files_.deploy(mode, origin, file)
 
     @proc
     def unlink(self, file):
+        if self.readonly:
+            raise PermissionError(s.READ_ONLY)
+        name = file
         file = path.clean(file, resolve=False)
-        source = file.resolve()
         if not file.exists():
             raise FileNotFoundError(s.FILE_NOT_FOUND.format(path=file))
         elif not os.access(file.parent, os.W_OK):
             raise PermissionError(s.PERMISSION_ERROR.format(path=file.parent))
-        elif (self.repository / 'refs') not in source.parents:
+        elif not self._owned(name, str(file)):
             raise FileExistsError(s.FILE_NOT_TRACKED.format(path=file))
         else:
             file.unlink()
@@ -0,0 +1,17 @@
+from carton.core import Module, proc
+from carton.util import strings as s
+
+class TraceModule(Module):
+    # NOTE: Returns the timings aggregated so far, or writes them to export, as
+    # plain statistics (json) or as Chrome trace events (chrome)
+    @proc
+    def trace(self, export=None, format='json'):
+        tracer = self.carton._tracer
+        if tracer is None:
+            raise RuntimeError(s.TRACE_DISABLED)
+        if format not in ('json', 'chrome'):
+            raise ValueError(s.UNKNOWN_TRACE_FORMAT.format(format=format))
+
+        if export is None:
+            return tracer.summary()
+        tracer.export(export, format=format)
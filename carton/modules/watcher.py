@@ -0,0 +1,33 @@
+import sys
+from carton.core import Module, proc
+from carton.util import strings as s, watch
+
+class WatcherModule(Module):
+    # NOTE: Changes to carton.json, carton.d/ or refs/ reload the configuration
+    # and run an incremental unpack, once the changes stopped for delay seconds.
+    # The session lock is only held while doing so, and released while waiting
+    @proc
+    def watch(self, delay=0.5, interval=1.0, limit=30, runs=None):
+        watcher = watch.watcher(interval)
+        watcher.add(self.repository, names=('carton.json', 'carton.d'))
+        watcher.add(self.repository / 'carton.d')
+        watcher.add(self.repository / 'refs', recursive=True)
+
+        try:
+            while runs is None or runs > 0:
+                try:
+                    with self.carton.unlocked():
+                        if not watcher.wait():
+                            continue
+                        watch.settle(watcher, delay, limit)
+
+                    # NOTE: Resuming the session reloaded the configuration
+                    report = self.proc('unpack', incremental=True)
+                    print(s.WATCH_UNPACKED.format(**report))
+                except Exception as e:
+                    print(s.WATCH_FAILED.format(error=e), file=sys.stderr)
+
+                if runs is not None:
+                    runs -= 1
+        finally:
+            watcher.close()
@@ -0,0 +1,123 @@
+import collections.abc
+import hashlib
+import os
+import shutil
+import tempfile
+
+from carton.util.strings import INVALID_CONFIGURATION, UNKNOWN_MODE
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MODES = ('symlink', 'reflink', 'hardlink', 'copy')
+FICLONE = 0x40049409
+CHUNK_SIZE = 1 << 20
+
+def digest(file):
+    hash = hashlib.sha256()
+    with open(str(file), 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+# NOTE: When the expected size is known, it is compared first, so that most
+# edits are caught without reading the file, and a file that also kept the
+# expected mtime is assumed unchanged without being read at all
+def intact(file, hash, size=None, mtime=None):
+    try:
+        stat = os.stat(str(file))
+        if size is not None and stat.st_size != size:
+            return False
+        elif size is not None and mtime is not None and stat.st_mtime_ns == mtime:
+            return True
+        return digest(file) == hash
+    except OSError:
+        return False
+
+# NOTE: Copies in the kernel whenever possible, first by sharing extents with
+# FICLONE, then with copy_file_range, which may still share them on some file
+# systems, then with sendfile, before falling back to a userspace copy
+def _clone(source, target):
+    size = os.fstat(source).st_size
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(target, FICLONE, source)
+            return
+        except OSError:
+            pass
+
+    for copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if copy is None:
+            continue
+        try:
+            offset = 0
+            while offset < size:
+                if copy is os.sendfile:
+                    sent = copy(target, source, offset, size - offset)
+                else:
+                    sent = copy(source, target, size - offset, offset, offset)
+                if sent == 0:
+                    break
+                offset += sent
+            if offset >= size:
+                return
+        except OSError:
+            pass
+        os.lseek(target, 0, os.SEEK_SET)
+        os.ftruncate(target, 0)
+
+    with open(source, 'rb', closefd=False) as s, open(target, 'wb', closefd=False) as t:
+        s.seek(0)
+        shutil.copyfileobj(s, t, CHUNK_SIZE)
+
+def _deploy(mode, source, target):
+    directory, name = os.path.split(target)
+    if mode == 'hardlink':
+        # NOTE: link() never follows nor replaces an existing name
+        temporary = tempfile.mktemp(prefix='.' + name, dir=directory)
+        os.link(source, temporary)
+        return temporary
+
+    fd, temporary = tempfile.mkstemp(prefix='.' + name, dir=directory)
+    try:
+        with open(source, 'rb') as s, os.fdopen(fd, 'wb') as t:
+            if mode == 'reflink':
+                _clone(s.fileno(), t.fileno())
+            else:
+                shutil.copyfileobj(s, t, CHUNK_SIZE)
+        shutil.copymode(source, temporary)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return temporary
+
+# NOTE: Real files are deployed next to their target and renamed over it, so
+# an existing file is replaced atomically
+def deploy(mode, source, target):
+    source, target = str(source), str(target)
+    if mode == 'symlink':
+        os.symlink(source, target, os.path.isdir(source))
+        return
+    elif mode not in MODES:
+        raise ValueError(UNKNOWN_MODE.format(mode=mode))
+
+    temporary = _deploy(mode, source, target)
+    try:
+        os.replace(temporary, target)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+# NOTE: Install entries are either a reference, deployed as a symlink, or a
+# mapping with the reference as 'ref' and an optional 'mode'
+def entry(value):
+    if isinstance(value, str):
+        return value, 'symlink'
+    elif isinstance(value, collections.abc.Mapping) and isinstance(value.get('ref', None), str):
+        mode = value.get('mode', 'symlink')
+        if mode not in MODES:
+            raise ValueError(UNKNOWN_MODE.format(mode=mode))
+        return value['ref'], mode
+    raise TypeError(INVALID_CONFIGURATION.format(element='install'))
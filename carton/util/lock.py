@@ -0,0 +1,65 @@
+import os
+import time
+
+from carton.util.strings import LOCKED
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# NOTE: With fcntl, locks are flock()s on a file that is never removed, so the
+# kernel releases them when their holder dies. Otherwise, the lock is held by
+# exclusively creating the file, and shared locks are exclusive as well
+class Lock:
+    def __init__(self, file, *, shared=False, timeout=0, interval=0.05):
+        self.file = file
+        self.shared = shared
+        self.timeout = timeout
+        self.interval = interval
+        self._fd = None
+
+    def _try(self):
+        if fcntl is not None:
+            fd = os.open(str(self.file), os.O_RDWR | os.O_CREAT, 0o644)
+            operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+        else:
+            try:
+                fd = os.open(str(self.file), os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                return False
+
+        self._fd = fd
+        return True
+
+    # NOTE: Waiting ignores the timeout, for holders that must get the lock back
+    def acquire(self, wait=False):
+        timeout = None if wait else self.timeout
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        while not self._try():
+            if timeout is not None and time.monotonic() >= deadline:
+                raise FileExistsError(LOCKED.format(path=self.file))
+            time.sleep(self.interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        else:
+            os.close(self._fd)
+            os.unlink(str(self.file))
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
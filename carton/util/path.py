@@ -1,6 +1,7 @@
 import os
 import pathlib
 import sys
+import tempfile
 
 from carton.util.strings import FILE_EXISTS
 
@@ -67,3 +68,29 @@ def state(root=None):
         raise FileExistsError(FILE_EXISTS.format(path=path))
 
     return path
+
+# NOTE: The data is written to a temporary file next to path and renamed over
+# it, so readers never see a partially written file
+def write(path, data):
+    path = pathlib.Path(path)
+    try:
+        mode = path.stat().st_mode & 0o777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+    fd, temporary = tempfile.mkstemp(prefix='.' + path.name, dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temporary, mode)
+        os.replace(temporary, str(path))
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except FileNotFoundError:
+            pass
+        raise
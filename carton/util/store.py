@@ -0,0 +1,225 @@
+import collections.abc
+import json
+import os
+
+from carton.util import path
+from carton.util.strings import CORRUPT_DATABASE, UNKNOWN_BACKEND
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+def _parent(file):
+    return str(path.clean(file, resolve=False).parent)
+
+def _under(value, prefix):
+    return value == prefix or value.startswith(prefix.rstrip(os.sep) + os.sep)
+
+# NOTE: Symlinks are stored as their bare reference, other deployments as a
+# mapping that also holds their mode, the hash of the deployed content, and the
+# mtime and size of the deployed file, which tell whether it must be hashed
+def _reference(value):
+    return value if isinstance(value, str) else value['reference']
+
+# NOTE: Stores map deployed files, as written in the configuration, to their
+# reference in the repository, and record how they were deployed. Every store
+# can answer reverse queries, by reference and by parent directory, and only
+# writes what changed on commit and close
+class JSONStore(collections.abc.MutableMapping):
+    filename = 'links.json'
+
+    def __init__(self, file, *, compact=False):
+        self.file = file
+        self.compact = compact
+        self.dirty = False
+
+        try:
+            with open(str(file)) as f:
+                self._data = json.load(f)
+        except FileNotFoundError:
+            self._data = {}
+
+        if not isinstance(self._data, collections.abc.MutableMapping):
+            raise ValueError(CORRUPT_DATABASE.format(file=file))
+
+    def __getitem__(self, file):
+        return _reference(self._data[file])
+
+    def __setitem__(self, file, reference):
+        self.record(file, reference)
+
+    def record(self, file, reference, mode='symlink', hash=None, mtime=None, size=None):
+        if mode == 'symlink':
+            value = reference
+        else:
+            value = {
+                'reference': reference, 'mode': mode, 'hash': hash,
+                'mtime': mtime, 'size': size
+            }
+        if self._data.get(file, None) != value:
+            self._data[file] = value
+            self.dirty = True
+
+    def entry(self, file):
+        value = self._data[file]
+        if isinstance(value, str):
+            return value, 'symlink', None, None, None
+        return value['reference'], value['mode'], value['hash'], \
+            value.get('mtime', None), value.get('size', None)
+
+    def entries(self):
+        return {file: self.entry(file) for file in self._data}
+
+    def __delitem__(self, file):
+        del self._data[file]
+        self.dirty = True
+
+    def __iter__(self):
+        return iter(tuple(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def by_reference(self, reference):
+        links = ((k, _reference(v)) for k, v in self._data.items())
+        return {k: v for k, v in links if _under(v, reference)}
+
+    def by_directory(self, directory):
+        directory = str(path.clean(directory, resolve=False))
+        return {
+            k: _reference(v) for k, v in self._data.items()
+            if _under(_parent(k), directory)
+        }
+
+    def commit(self):
+        if self.dirty:
+            if self.compact:
+                data = json.dumps(self._data, separators=(',', ':'))
+            else:
+                data = json.dumps(self._data, indent=2)
+            path.write(self.file, data)
+            self.dirty = False
+
+    def close(self):
+        self.commit()
+
+class SQLiteStore(collections.abc.MutableMapping):
+    filename = 'links.db'
+
+    def __init__(self, file, **kwargs):
+        self.file = file
+        self._connection = sqlite3.connect(str(file))
+        try:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS links (
+                    file TEXT PRIMARY KEY,
+                    reference TEXT NOT NULL,
+                    parent TEXT NOT NULL,
+                    mode TEXT NOT NULL DEFAULT 'symlink',
+                    hash TEXT,
+                    mtime INTEGER,
+                    size INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS links_reference ON links (reference);
+                CREATE INDEX IF NOT EXISTS links_parent ON links (parent);
+            ''')
+
+            # Add the deployment columns to databases from older versions
+            columns = {row[1] for row in self._query('PRAGMA table_info(links)')}
+            if 'mode' not in columns:
+                self._connection.executescript('''
+                    ALTER TABLE links ADD COLUMN mode TEXT NOT NULL DEFAULT 'symlink';
+                    ALTER TABLE links ADD COLUMN hash TEXT;
+                ''')
+            if 'mtime' not in columns:
+                self._connection.executescript('''
+                    ALTER TABLE links ADD COLUMN mtime INTEGER;
+                    ALTER TABLE links ADD COLUMN size INTEGER;
+                ''')
+        except sqlite3.DatabaseError as e:
+            self._connection.close()
+            raise ValueError(CORRUPT_DATABASE.format(file=file)) from e
+
+    @property
+    def dirty(self):
+        return self._connection.in_transaction
+
+    def _query(self, sql, *parameters):
+        return self._connection.execute(sql, parameters)
+
+    def __getitem__(self, file):
+        row = self._query('SELECT reference FROM links WHERE file = ?', file).fetchone()
+        if row is None:
+            raise KeyError(file)
+        return row[0]
+
+    def __setitem__(self, file, reference):
+        self.record(file, reference)
+
+    def record(self, file, reference, mode='symlink', hash=None, mtime=None, size=None):
+        self._query(
+            'INSERT OR REPLACE INTO links '
+            '(file, reference, parent, mode, hash, mtime, size) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            file, reference, _parent(file), mode, hash, mtime, size)
+
+    def entry(self, file):
+        row = self._query(
+            'SELECT reference, mode, hash, mtime, size FROM links WHERE file = ?',
+            file).fetchone()
+        if row is None:
+            raise KeyError(file)
+        return tuple(row)
+
+    def entries(self):
+        rows = self._query('SELECT file, reference, mode, hash, mtime, size FROM links')
+        return {row[0]: tuple(row[1:]) for row in rows.fetchall()}
+
+    def __delitem__(self, file):
+        if self._query('DELETE FROM links WHERE file = ?', file).rowcount == 0:
+            raise KeyError(file)
+
+    def __iter__(self):
+        return iter([row[0] for row in self._query('SELECT file FROM links')])
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM links').fetchone()[0]
+
+    def __contains__(self, file):
+        return self._query('SELECT 1 FROM links WHERE file = ?', file).fetchone() is not None
+
+    # NOTE: Prefix lookups are written as ranges so that they use the indexes,
+    # '0' being the character right after the separator
+    def _under(self, column, prefix):
+        prefix = prefix.rstrip(os.sep)
+        rows = self._query(
+            'SELECT file, reference FROM links WHERE {column} = ? '
+            'OR ({column} >= ? AND {column} < ?)'.format(column=column),
+            prefix, prefix + os.sep, prefix + chr(ord(os.sep) + 1))
+        return dict(rows.fetchall())
+
+    def by_reference(self, reference):
+        return self._under('reference', reference)
+
+    def by_directory(self, directory):
+        return self._under('parent', str(path.clean(directory, resolve=False)))
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+BACKENDS = {'json': JSONStore}
+if sqlite3 is not None:
+    BACKENDS['sqlite'] = SQLiteStore
+
+DEFAULT_BACKEND = 'sqlite' if sqlite3 is not None else 'json'
+
+def backend(name=None):
+    name = DEFAULT_BACKEND if name is None else name
+    if name not in BACKENDS:
+        raise ValueError(UNKNOWN_BACKEND.format(backend=name))
+    return BACKENDS[name]
@@ -14,7 +14,27 @@ PYTHON_MODULE_EXPECTED = "expected a Python module or 'str', got '{bad_type}'"
 DECORATED_NOT_CALLABLE = "decorated value is not callable"
 WRONG_TYPE = "expected {expected} but got {bad_type}"
 INVALID_CONFIGURATION = "configuration element '{element}' has an unexpected format"
+CORRUPT_DATABASE = "database '{file}' is corrupt"
+UNKNOWN_BACKEND = "unknown state backend '{backend}'"
+LOCKED = "'{path}' is locked by another process"
+READ_ONLY = "cannot modify state from a read-only session"
+UNKNOWN_REQUEST = "unknown request kind '{kind}'"
+DAEMON_UNAVAILABLE = "the Carton daemon is not available on this platform"
+DAEMON_NOT_RUNNING = "the Carton daemon is not running"
+DAEMON_BLOCKING = "'{name}' cannot run in the Carton daemon"
+CONFLICTING_TARGETS = "'{file}' conflicts with '{other}'"
+UNPACK_FAILED = "{count} operation(s) failed during unpack:{details}"
+TRACE_DISABLED = "tracing is not enabled in this session"
+UNKNOWN_TRACE_FORMAT = "unknown trace format '{format}'"
+UNKNOWN_MODE = "unknown deployment mode '{mode}'"
+NOT_A_FILE = "'{path}' must be a file to be deployed as a {mode}"
 
 # Command-line messages
 CORRUPT_FILE = "Warning! File '{file}' could not be loaded as expected. The original file was moved to {file}.bak, and empty data is used instead."
+COMMAND_FAILED = "carton: {error}"
+WATCH_UNPACKED = "Unpacked: {added} added, {changed} changed, {removed} removed, {unchanged} unchanged"
+WATCH_FAILED = "Warning! Unpacking after a change failed: {error}"
 CONDITION_CRASH = "Warning! Condition '{condition}' could not be evaluated properly. Assuming it evaluates to False."
+FLEET_SUCCESS = "{root}: {added} added, {changed} changed, {removed} removed, {unchanged} unchanged in {elapsed:.3f}s (load {load:.3f}s)"
+FLEET_FAILURE = "{root}: failed after {elapsed:.3f}s: {error}"
+FLEET_SUMMARY = "{succeeded}/{total} root(s) deployed in {elapsed:.3f}s"
@@ -0,0 +1,91 @@
+import heapq
+import json
+import os
+import threading
+import time
+
+# NOTE: Records calls made through Core, aggregated by kind, module and name,
+# and as individual events for the Chrome trace format, up to limit of them
+class Tracer:
+    def __init__(self, slowest=5, limit=100000):
+        self.slowest = slowest
+        self.limit = limit
+        self.stats = {}
+        self.events = []
+        self.dropped = 0
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, kind, module, name, start, end):
+        duration = end - start
+        with self._lock:
+            key = (kind, module, name)
+            stats = self.stats.get(key, None)
+            if stats is None:
+                stats = self.stats[key] = [0, 0.0, []]
+            stats[0] += 1
+            stats[1] += duration
+
+            if len(stats[2]) < self.slowest:
+                heapq.heappush(stats[2], duration)
+            elif duration > stats[2][0]:
+                heapq.heapreplace(stats[2], duration)
+
+            if len(self.events) < self.limit:
+                self.events.append((
+                    kind, module, name, start - self._origin, duration,
+                    threading.get_ident()))
+            else:
+                self.dropped += 1
+
+    def call(self, kind, module, name, f, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.record(kind, module, name, start, time.perf_counter())
+
+    async def wait(self, kind, module, name, awaitable, start):
+        try:
+            return await awaitable
+        finally:
+            self.record(kind, module, name, start, time.perf_counter())
+
+    def summary(self):
+        with self._lock:
+            summary = [
+                {
+                    'kind': kind,
+                    'module': module,
+                    'name': name,
+                    'calls': calls,
+                    'total': total,
+                    'slowest': sorted(slowest, reverse=True),
+                }
+                for (kind, module, name), (calls, total, slowest) in self.stats.items()
+            ]
+        summary.sort(key=lambda entry: entry['total'], reverse=True)
+        return summary
+
+    def chrome(self):
+        pid = os.getpid()
+        with self._lock:
+            events = [
+                {
+                    'name': '{kind} {name}'.format(kind=kind, name=name),
+                    'cat': kind,
+                    'ph': 'X',
+                    'ts': start * 1e6,
+                    'dur': duration * 1e6,
+                    'pid': pid,
+                    'tid': tid,
+                    'args': {'module': module},
+                }
+                for kind, module, name, start, duration, tid in self.events
+            ]
+        return {'traceEvents': events, 'otherData': {'dropped': self.dropped}}
+
+    def export(self, file, format='json'):
+        data = self.chrome() if format == 'chrome' else {'stats': self.summary()}
+        with open(str(file), 'w') as f:
+            json.dump(data, f)
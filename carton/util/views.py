@@ -0,0 +1,63 @@
+import collections.abc
+import copy
+
+class ReadOnlyMapping(collections.abc.Mapping):
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return view(self._data[key])
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '{name}({data!r})'.format(name=type(self).__name__, data=self._data)
+
+    def copy(self):
+        return copy.deepcopy(self._data)
+
+class ReadOnlySequence(collections.abc.Sequence):
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ReadOnlySequence(self._data[index])
+        return view(self._data[index])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, ReadOnlySequence):
+            other = other._data
+        return isinstance(other, collections.abc.Sequence) and \
+            len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return '{name}({data!r})'.format(name=type(self).__name__, data=self._data)
+
+    def copy(self):
+        return copy.deepcopy(self._data)
+
+# NOTE: Containers are wrapped lazily, as they get accessed, so making a view
+# costs the same no matter how large the underlying data is
+def view(value):
+    if isinstance(value, (ReadOnlyMapping, ReadOnlySequence)):
+        return value
+    elif isinstance(value, collections.abc.Mapping):
+        return ReadOnlyMapping(value)
+    elif isinstance(value, (str, bytes)):
+        return value
+    elif isinstance(value, collections.abc.Sequence):
+        return ReadOnlySequence(value)
+    else:
+        return value
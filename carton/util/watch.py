@@ -0,0 +1,197 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# Constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT = struct.Struct('iIII')
+
+def _libc():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    return libc
+
+# NOTE: Watchers follow a set of directories, either recursively or only for
+# some of their entries, and wait() returns True as soon as something changed
+class PollingWatcher:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._specs = []
+        self._snapshot = {}
+
+    def add(self, directory, recursive=False, names=None):
+        self._specs.append((str(directory), recursive, names))
+        self._snapshot = self._scan()
+
+    def _walk(self, directory, snapshot):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+
+        for entry in entries:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            if entry.is_dir(follow_symlinks=False):
+                self._walk(entry.path, snapshot)
+
+    def _scan(self):
+        snapshot = {}
+        for directory, recursive, names in self._specs:
+            if recursive:
+                self._walk(directory, snapshot)
+                continue
+
+            try:
+                entries = names or os.listdir(directory)
+            except OSError:
+                continue
+
+            for name in entries:
+                file = os.path.join(directory, name)
+                try:
+                    stat = os.stat(file)
+                    snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    pass
+
+        return snapshot
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            if snapshot != self._snapshot:
+                self._snapshot = snapshot
+                return True
+
+            if deadline is None:
+                time.sleep(self.interval)
+            elif time.monotonic() >= deadline:
+                return False
+            else:
+                time.sleep(min(self.interval, max(0, deadline - time.monotonic())))
+
+    def close(self):
+        self._specs = []
+
+class InotifyWatcher:
+    def __init__(self, libc):
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        # NOTE: This maps watch descriptors to (directory, recursive, names)
+        self._watches = {}
+
+    def add(self, directory, recursive=False, names=None):
+        directory = str(directory)
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), MASK)
+        if wd < 0:
+            return
+
+        self._watches[wd] = (directory, recursive, names)
+        if recursive:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                return
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    self.add(entry.path, True)
+
+    def _drain(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length]
+                name = os.fsdecode(name.rstrip(b'\0'))
+                offset += EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    changed = True
+                    continue
+
+                directory, recursive, names = self._watches.get(wd, (None, False, None))
+                if directory is None or (names is not None and name not in names):
+                    continue
+
+                changed = True
+                if recursive and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add(os.path.join(directory, name), True)
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    del self._watches[wd]
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select((self._fd,), (), (), remaining)
+            if not ready:
+                return False
+            elif self._drain():
+                return True
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+def watcher(interval=1.0):
+    libc = _libc()
+    if libc is not None:
+        try:
+            return InotifyWatcher(libc)
+        except OSError:
+            pass
+
+    return PollingWatcher(interval)
+
+# NOTE: Waits until no change happened for delay seconds, or limit is reached,
+# so that bursts of changes are handled once
+def settle(watcher, delay, limit=None):
+    start = time.monotonic()
+    while watcher.wait(delay):
+        if limit is not None and time.monotonic() - start >= limit:
+            break
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+from os import path
 from setuptools import setup
 from sys import platform
 
@@ -44,7 +45,8 @@ setup(
 
     entry_points={
         'console_scripts': [
-            'carton=carton:main'
+            'carton=carton:main',
+            'carton-fleet=carton.fleet:main'
         ]
     }
 )